@@ -0,0 +1,374 @@
+"""取り込み（要約）と全文OCRのスループットを計測するベンチマーク
+
+スタブサーバー（bench/stub_server.py）を別プロセスで起動し、合成したPDF・JPEGを
+PDFProcessor / ImageProcessor で取り込んだ後、ObsidianOCREnhancer で全文OCRを行う。
+結果はJSONで出力され、リリース間の比較に使える。
+
+    uv run bench/run_bench.py --pdfs 20 --jpegs 10 --latency 0.5 --tokens-per-sec 50
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+PROJECT_ROOT = BENCH_DIR.parent
+sys.path.insert(0, str(PROJECT_ROOT / "src"))
+sys.path.insert(0, str(BENCH_DIR))
+
+# 処理側のモジュールが import 時に basicConfig を呼ぶ前に、ベンチマーク側の設定を済ませる
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+from stub_server import OCR_MARKER  # noqa: E402
+from synthetic import generate_jpegs, generate_pdfs  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def percentile(values, pct):
+    """線形補間によるパーセンタイル（values が空なら None）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def peak_rss_mb():
+    """このプロセスの最大常駐メモリ（MB）。取得できない環境では None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイト単位
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class DiskUsageSampler:
+    """一時ディレクトリの使用量を定期的に計測し、最大値を記録する"""
+
+    def __init__(self, path, interval=0.2):
+        self.path = path
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="disk-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_bytes = max(self.peak_bytes, directory_size(self.path))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, directory_size(self.path))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_stub(args, port):
+    """スタブサーバーを別プロセスで起動し、応答するまで待つ"""
+    process = subprocess.Popen(
+        [sys.executable, str(BENCH_DIR / "stub_server.py"), "--port", str(port),
+         "--latency", str(args.latency), "--tokens-per-sec", str(args.tokens_per_sec),
+         "--ocr-chars", str(args.ocr_chars)],
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/v1/models", timeout=1).read()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Stub server did not start")
+
+
+def stub_stats(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/v1/stats", timeout=5) as r:
+        return json.load(r)
+
+
+def build_config(work_dir, port, args):
+    """ベンチマーク用の設定（LLM応答キャッシュは無効）"""
+    return {
+        "common": {
+            "lm_studio_base_url": f"http://127.0.0.1:{port}/v1",
+            "llm_model": "bench",
+            "temp_directory": str(work_dir / "tmp"),
+            "keep_temp_files": args.keep_temp_files,
+            "history_backend": "sqlite",
+            "history_db": str(work_dir / "data" / "history.sqlite3"),
+            "history_file": str(work_dir / "data" / "history.json"),
+            "scan_index_file": str(work_dir / "data" / "scan_index.sqlite3"),
+            "max_concurrent_llm_requests": args.llm_concurrency,
+            "render_lookahead": 2,
+            "llm_cache": {"enabled": False},
+            "image_payload": {"enabled": args.image_payload},
+            "render_pool": {"enabled": args.render_processes > 0, "processes": args.render_processes},
+            "page_analysis": {"enabled": args.page_analysis},
+        },
+        "summarizer": {
+            "control": {"force_reprocess": False, "max_workers": args.max_workers},
+            "pdf": {
+                "input_directory": str(work_dir / "in" / "pdf"),
+                "auto_rename": True,
+                "auto_copy": True,
+                "destination_directory": str(work_dir / "vault" / "PDFs"),
+            },
+            "jpeg": {
+                "input_directory": str(work_dir / "in" / "jpeg"),
+                "auto_rename": True,
+                "auto_copy": True,
+                "destination_directory": str(work_dir / "vault" / "Images"),
+                "batch": {"enabled": args.jpeg_batch > 1, "max_images": args.jpeg_batch},
+            },
+            "markdown_output": {"destination_directory": str(work_dir / "vault" / "ScanSnapHome")},
+            "output_index": {"enabled": not args.no_output_index},
+            "ai_analysis": {
+                "enable_categorization": False,
+                "prompt": "提供された書類の画像から、title, category, author, published, description, tags, summary をJSONで出力してください。",
+                "max_pages_to_ai": 5,
+            },
+        },
+        "ocr_enhancer": {
+            "fulltext_enabled": True,
+            "output_directory": str(work_dir / "vault" / "ScanSnapHome"),
+            "fulltext_prompt": f"{OCR_MARKER} PAGE{{page_number}} この画像は書類の{{page_number}}ページ目です。記載されている文字をすべて読み取ってください。",
+            "fulltext_max_pages": args.ocr_max_pages,
+            "page_concurrency": args.page_concurrency,
+        },
+    }
+
+
+def run_ingest(config, pdfs, jpegs, max_workers):
+    """PDF・JPEGを取り込み、書類ごとの処理時間を計測する"""
+    from processors.image_processor import ImageProcessor
+    from processors.pdf_processor import PDFProcessor
+
+    pdf_processor = PDFProcessor(config, config["summarizer"]["pdf"])
+    image_processor = ImageProcessor(config, config["summarizer"]["jpeg"])
+    # JPEGのバッチ処理が有効な場合は batch_size 枚ずつまとめて処理する
+    size = image_processor.batch_size
+    tasks = [(pdf_processor, [path], pages) for path, pages in pdfs] + \
+        [(image_processor, jpegs[i:i + size], 1) for i in range(0, len(jpegs), size)]
+
+    def run(processor, paths):
+        started = time.perf_counter()
+        if len(paths) == 1:
+            results = [processor.process(str(paths[0]), "")]
+        else:
+            results = processor.process_batch([(str(path), "") for path in paths])
+        return results, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = [(executor.submit(run, processor, paths), pages) for processor, paths, pages in tasks]
+        outcomes = [(future.result(), pages) for future, pages in futures]
+    wall = time.perf_counter() - started
+    # ノートが上書きされて減っていると、続くOCRの計測が別の作業量になるため中止する
+    notes = len(list(Path(config["summarizer"]["markdown_output"]["destination_directory"]).rglob("*.md")))
+    if notes != len(pdfs) + len(jpegs):
+        raise RuntimeError(f"Ingest produced {notes} notes for {len(pdfs) + len(jpegs)} input files.")
+    # まとめて処理した書類は、それぞれの処理時間をまとめた処理全体の時間とみなす
+    return summarize_stage(wall, [(ok, seconds, pages) for (results, seconds), pages in outcomes for ok in results])
+
+
+def run_ocr(config):
+    """取り込まれたMarkdownすべてに全文OCRを追記し、ノートごとの処理時間を計測する"""
+    import fitz  # PyMuPDF
+    from obsidian_ocr_enhancer import ObsidianOCREnhancer
+
+    enhancer = ObsidianOCREnhancer(config)
+    output_dir = config["ocr_enhancer"]["output_directory"]
+    max_pages = config["ocr_enhancer"]["fulltext_max_pages"]
+    notes = sorted(Path(output_dir).rglob("*.md"))
+
+    outcomes = []
+    started = time.perf_counter()
+    for note in notes:
+        note_started = time.perf_counter()
+        ok = enhancer.enhance_markdown(str(note))
+        seconds = time.perf_counter() - note_started
+        outcomes.append((ok, seconds, 0))
+    wall = time.perf_counter() - started
+
+    # OCRしたページ数は原本の複製から数える
+    pages = 0
+    for directory in (config["summarizer"]["pdf"]["destination_directory"],
+                      config["summarizer"]["jpeg"]["destination_directory"]):
+        for path in Path(directory).rglob("*"):
+            if path.suffix.lower() in (".pdf", ".jpg", ".jpeg"):
+                with fitz.open(path) as doc:
+                    pages += min(len(doc), max_pages)
+    return summarize_stage(wall, outcomes, total_pages=pages)
+
+
+def summarize_stage(wall, outcomes, total_pages=None):
+    latencies = [seconds for _, seconds, _ in outcomes]
+    if total_pages is None:
+        total_pages = sum(pages for _, _, pages in outcomes)
+    docs = len(outcomes)
+    minutes = wall / 60 if wall > 0 else None
+    return {
+        "documents": docs,
+        "succeeded": sum(1 for ok, _, _ in outcomes if ok),
+        "failed": sum(1 for ok, _, _ in outcomes if ok is False),
+        "pages": total_pages,
+        "wall_seconds": round(wall, 3),
+        "docs_per_min": round(docs / minutes, 2) if minutes else None,
+        "pages_per_min": round(total_pages / minutes, 2) if minutes else None,
+        "latency_p50_seconds": _round(percentile(latencies, 50)),
+        "latency_p95_seconds": _round(percentile(latencies, 95)),
+        "latency_max_seconds": _round(max(latencies) if latencies else None),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def _round(value):
+    return None if value is None else round(value, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="取り込み・全文OCRのベンチマーク")
+    parser.add_argument("--pdfs", type=int, default=20, help="生成するPDFの数")
+    parser.add_argument("--jpegs", type=int, default=10, help="生成するJPEGの数")
+    parser.add_argument("--min-pages", type=int, default=1)
+    parser.add_argument("--max-pages", type=int, default=12)
+    parser.add_argument("--image-only-ratio", type=float, default=0.5,
+                        help="テキストレイヤーのない（画像のみの）PDFの割合")
+    parser.add_argument("--blank-ratio", type=float, default=0.0,
+                        help="白紙にするページ（1ページ目以外）の割合")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.5, help="スタブサーバーの応答開始までの待ち時間（秒）")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0, help="スタブサーバーの生成速度")
+    parser.add_argument("--ocr-chars", type=int, default=800, help="全文OCRの応答1ページあたりの文字数")
+    parser.add_argument("--max-workers", type=int, default=1, help="summarizer.control.max_workers")
+    parser.add_argument("--llm-concurrency", type=int, default=1, help="common.max_concurrent_llm_requests")
+    parser.add_argument("--jpeg-batch", type=int, default=1,
+                        help="summarizer.jpeg.batch.max_images（2以上でJPEGのバッチ処理を有効にする）")
+    parser.add_argument("--page-concurrency", type=int, default=1, help="ocr_enhancer.page_concurrency")
+    parser.add_argument("--ocr-max-pages", type=int, default=50, help="ocr_enhancer.fulltext_max_pages")
+    parser.add_argument("--render-processes", type=int, default=0,
+                        help="common.render_pool.processes（1以上で画像化を別プロセスで行う）")
+    parser.add_argument("--image-payload", action="store_true", help="common.image_payload を有効にする")
+    parser.add_argument("--page-analysis", action="store_true", help="common.page_analysis を有効にする")
+    parser.add_argument("--no-output-index", action="store_true", help="summarizer.output_index を無効にする")
+    parser.add_argument("--keep-temp-files", action="store_true", help="common.keep_temp_files を有効にする")
+    parser.add_argument("--skip-ocr", action="store_true", help="全文OCRの計測を省略する")
+    parser.add_argument("--work-dir", help="作業ディレクトリ（省略時は一時ディレクトリを作成して最後に削除）")
+    parser.add_argument("--output", help="結果のJSONの出力先（省略時は bench/results/ 以下）")
+    parser.add_argument("--verbose", action="store_true", help="処理側のログを表示する")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+
+    cleanup = args.work_dir is None
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix="scansnap_bench_")).resolve()
+    port = free_port()
+    stub = start_stub(args, port)
+    try:
+        config = build_config(work_dir, port, args)
+        for directory in ("tmp", "data"):
+            (work_dir / directory).mkdir(parents=True, exist_ok=True)
+
+        logging.warning(f"Generating synthetic scans in {work_dir}")
+        pdfs = generate_pdfs(work_dir / "in" / "pdf", args.pdfs, args.min_pages, args.max_pages,
+                             args.image_only_ratio, args.seed, args.blank_ratio)
+        jpegs = generate_jpegs(work_dir / "in" / "jpeg", args.jpegs, args.seed)
+        input_bytes = directory_size(work_dir / "in")
+
+        results = {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git_revision": _git_revision(),
+            "system": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+            },
+            "parameters": {k: v for k, v in vars(args).items() if k not in ("output", "work_dir", "verbose")},
+            "input": {"pdfs": len(pdfs), "jpegs": len(jpegs), "pages": sum(p for _, p in pdfs) + len(jpegs),
+                      "bytes": input_bytes},
+        }
+
+        logging.warning("Running ingest benchmark...")
+        with DiskUsageSampler(work_dir / "tmp") as disk:
+            results["ingest"] = run_ingest(config, pdfs, jpegs, args.max_workers)
+        results["ingest"]["temp_disk_peak_bytes"] = disk.peak_bytes
+        results["ingest"]["llm_requests"] = stub_stats(port)["requests"]
+
+        if not args.skip_ocr:
+            requests_before = stub_stats(port)["requests"]
+            logging.warning("Running OCR benchmark...")
+            with DiskUsageSampler(work_dir / "tmp") as disk:
+                results["ocr"] = run_ocr(config)
+            results["ocr"]["temp_disk_peak_bytes"] = disk.peak_bytes
+            results["ocr"]["llm_requests"] = stub_stats(port)["requests"] - requests_before
+
+        results["stub"] = stub_stats(port)
+    finally:
+        from core.render_pool import shutdown_render_pool
+        shutdown_render_pool()
+        stub.terminate()
+        stub.wait()
+        if cleanup:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = Path(args.output) if args.output else \
+        BENCH_DIR / "results" / f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    logging.warning(f"Results written to {output}")
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""ベンチマーク用の LM Studio 代替サーバー（OpenAI互換の /v1/chat/completions）
+
+応答までの待ち時間（--latency）と生成速度（--tokens-per-sec）を指定でき、
+要約リクエストにはリクエストごとに異なるタイトルのJSON、全文OCRリクエスト（プロンプトに BENCH_OCR を含むもの）には
+指定した長さの本文を返す。stream=true の場合は生成速度に合わせて少しずつ送信する。
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+OCR_MARKER = "BENCH_OCR"
+
+_SUMMARY = {
+    "title": "ベンチマーク書類",
+    "category": "99_過去・その他",
+    "author": "ベンチマーク",
+    "published": "2024/01/02",
+    "description": "ベンチマーク用の合成書類",
+    "tags": ["benchmark"],
+    "summary": "ベンチマーク用に生成された書類の要約です。",
+}
+
+
+class StubState:
+    """サーバー全体の設定と統計"""
+
+    def __init__(self, latency, tokens_per_sec, ocr_chars):
+        self.latency = latency
+        self.tokens_per_sec = tokens_per_sec
+        self.ocr_chars = ocr_chars
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.cancelled = 0
+        # 要約のタイトルに付ける通し番号（書類ごとに別のノートになるようにする）
+        self.summaries = 0
+        # 直前のリクエストのプロンプト（サーバーのプロンプトキャッシュの模擬に使う）
+        self.last_prompt = ""
+
+    def enter(self):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def next_summary_ids(self, count):
+        """要約 count 件分の通し番号を払い出す"""
+        with self.lock:
+            first = self.summaries + 1
+            self.summaries += count
+        return range(first, first + count)
+
+    def cached_prefix(self, prompt):
+        """直前のリクエストとプロンプトの先頭が一致する文字数を返し、今回のプロンプトを記録する"""
+        with self.lock:
+            previous, self.last_prompt = self.last_prompt, prompt
+        return len(os.path.commonprefix([previous, prompt]))
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "in_flight": self.in_flight, "max_in_flight": self.max_in_flight,
+                    "cancelled": self.cancelled}
+
+
+def _prompt_text(body):
+    """リクエスト中のテキスト部分だけを連結する（画像のdata URLは除く）"""
+    texts = []
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+        elif isinstance(content, list):
+            texts.extend(part.get("text", "") for part in content if part.get("type") == "text")
+    return "\n".join(texts)
+
+
+def _count_images(body):
+    return sum(
+        1
+        for message in body.get("messages", [])
+        if isinstance(message.get("content"), list)
+        for part in message["content"]
+        if part.get("type") == "image_url"
+    )
+
+
+def _summary(summary_id):
+    return {**_SUMMARY, "title": f"{_SUMMARY['title']} {summary_id:05d}"}
+
+
+def _completion_text(prompt, state):
+    if OCR_MARKER not in prompt:
+        # 複数の画像をまとめた要約（JPEGのバッチ処理）には、画像ごとの結果を配列で返す
+        batch = len(re.findall(r"^画像 \d+:$", prompt, re.MULTILINE))
+        if batch:
+            return json.dumps([_summary(i) for i in state.next_summary_ids(batch)], ensure_ascii=False)
+        return json.dumps(_summary(state.next_summary_ids(1)[0]), ensure_ascii=False)
+    ocr_chars = state.ocr_chars
+    match = re.search(r"PAGE(\d+)", prompt)
+    page = match.group(1) if match else "?"
+    # 同じ行の繰り返しは生成ループとみなされて打ち切られるため、行ごとに番号を変える
+    lines = []
+    while sum(len(line) for line in lines) < ocr_chars:
+        lines.append(f"{len(lines) + 1}. ベンチマーク用の本文テキストです。金額は{(len(lines) + 1) * 1200:,}円です。\n")
+    body = "".join(lines)[:ocr_chars]
+    return f"### ページ {page}\n\n{body}"
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, payload, status=200):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/models"):
+                self._send_json({"object": "list", "data": [{"id": "bench", "object": "model", "created": 0, "owned_by": "bench"}]})
+            elif self.path.rstrip("/").endswith("/stats"):
+                self._send_json(state.stats())
+            else:
+                self._send_json({"error": "not found"}, status=404)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            raw = self.rfile.read(length)
+            body = json.loads(raw)
+            state.enter()
+            try:
+                prompt = _prompt_text(body)
+                text = _completion_text(prompt, state)
+                # トークン数は日本語1文字=1トークン程度の概算とする
+                usage = {
+                    "prompt_tokens": len(prompt) + 256 * _count_images(body),
+                    "completion_tokens": len(text),
+                }
+                usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+                # 先頭が直前のリクエストと同じ部分は、プロンプトキャッシュから読み込んだものとして報告する
+                usage["prompt_tokens_details"] = {"cached_tokens": state.cached_prefix(prompt)}
+                time.sleep(state.latency)
+                if body.get("stream"):
+                    self._stream(body, text, usage)
+                else:
+                    if state.tokens_per_sec > 0:
+                        time.sleep(len(text) / state.tokens_per_sec)
+                    self._send_json({
+                        "id": "bench", "object": "chat.completion", "created": int(time.time()),
+                        "model": body.get("model", "bench"),
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                        "usage": usage,
+                    })
+            finally:
+                state.leave()
+
+        def _stream(self, body, text, usage):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            chunk_chars = 8
+            delay = chunk_chars / state.tokens_per_sec if state.tokens_per_sec > 0 else 0
+            model = body.get("model", "bench")
+            self.close_connection = True
+            try:
+                for i in range(0, len(text), chunk_chars):
+                    chunk = {
+                        "id": "bench", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                        "choices": [{"index": 0, "delta": {"content": text[i:i + chunk_chars]}, "finish_reason": None}],
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                    if delay:
+                        time.sleep(delay)
+                final = {
+                    "id": "bench", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                    "usage": usage,
+                }
+                self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # クライアントが生成を途中で打ち切った
+                with state.lock:
+                    state.cancelled += 1
+
+    return Handler
+
+
+def serve(port, latency=0.5, tokens_per_sec=50.0, ocr_chars=800, host="127.0.0.1"):
+    state = StubState(latency, tokens_per_sec, ocr_chars)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ベンチマーク用の OpenAI互換スタブサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--latency", type=float, default=0.5, help="応答開始までの待ち時間（秒）")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0, help="生成速度（0で待ち時間なし）")
+    parser.add_argument("--ocr-chars", type=int, default=800, help="全文OCRの応答1ページあたりの文字数")
+    args = parser.parse_args()
+
+    server, _ = serve(args.port, args.latency, args.tokens_per_sec, args.ocr_chars, args.host)
+    print(f"Stub server listening on http://{args.host}:{server.server_address[1]}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
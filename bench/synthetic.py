@@ -0,0 +1,90 @@
+"""ベンチマーク用の合成スキャンデータ（PDF・JPEG）を fitz で生成する"""
+import random
+from pathlib import Path
+import fitz  # PyMuPDF
+
+PAPER_SIZES = ["a4", "a3", "b5", "letter"]
+
+_LINES = [
+    "請求書 株式会社サンプル商事 御中",
+    "下記の通りご請求申し上げます。",
+    "合計金額 ¥12,000（税込）",
+    "お支払い期限 2024年1月31日",
+    "振込先 サンプル銀行 本店営業部 普通 1234567",
+    "品名 数量 単価 金額",
+    "事務用品一式 1 12,000 12,000",
+    "備考：本書類はベンチマーク用に生成されたものです。",
+]
+
+
+def _draw_page(page, rng, doc_index, page_index):
+    """表の罫線と日本語テキストを描いて、スキャンした書類らしいページを作る"""
+    width, height = page.rect.width, page.rect.height
+    page.draw_rect(fitz.Rect(36, 36, width - 36, height - 36), color=(0.2, 0.2, 0.2), width=1)
+    y = 72
+    page.insert_text((54, y), f"書類 {doc_index} / ページ {page_index + 1}", fontname="japan", fontsize=16)
+    y += 32
+    while y < height - 72:
+        line = rng.choice(_LINES)
+        page.insert_text((54, y), line, fontname="japan", fontsize=rng.choice([9, 10, 11, 12]))
+        y += rng.randint(16, 28)
+        if rng.random() < 0.1:
+            page.draw_line(fitz.Point(54, y - 8), fitz.Point(width - 54, y - 8), color=(0.5, 0.5, 0.5))
+
+
+def generate_pdfs(out_dir, count, min_pages=1, max_pages=12, image_only_ratio=0.5, seed=0, blank_ratio=0.0):
+    """ページ数・用紙サイズの異なるPDFを count 件生成し、(パス, ページ数) のリストを返す
+
+    image_only_ratio の割合で、ページ全体を画像として埋め込んだ（テキストレイヤーのない）
+    スキャン相当のPDFを生成する。blank_ratio の割合で、1ページ目以外を白紙
+    （両面スキャンの裏面相当）にする。
+    """
+    rng = random.Random(seed)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    generated = []
+    for k in range(count):
+        page_count = rng.randint(min_pages, max_pages)
+        paper = rng.choice(PAPER_SIZES)
+        width, height = fitz.paper_size(paper)
+        image_only = rng.random() < image_only_ratio
+        source = fitz.open()
+        for p in range(page_count):
+            page = source.new_page(width=width, height=height)
+            if p > 0 and blank_ratio > 0 and rng.random() < blank_ratio:
+                continue
+            _draw_page(page, rng, k, p)
+        if image_only:
+            doc = fitz.open()
+            for page in source:
+                pix = page.get_pixmap(matrix=fitz.Matrix(1.5, 1.5), colorspace=fitz.csRGB)
+                new_page = doc.new_page(width=width, height=height)
+                new_page.insert_image(new_page.rect, stream=pix.tobytes("jpeg"))
+            source.close()
+        else:
+            doc = source
+        path = out_dir / f"bench_{k:04d}_{paper}_{page_count}p.pdf"
+        doc.save(path, garbage=3, deflate=True)
+        doc.close()
+        generated.append((path, page_count))
+    return generated
+
+
+def generate_jpegs(out_dir, count, seed=0, dpi=150):
+    """用紙サイズの異なる書類画像（JPEG）を count 件生成し、パスのリストを返す"""
+    rng = random.Random(seed + 1)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    generated = []
+    for k in range(count):
+        paper = rng.choice(PAPER_SIZES)
+        width, height = fitz.paper_size(paper)
+        doc = fitz.open()
+        page = doc.new_page(width=width, height=height)
+        _draw_page(page, rng, k, 0)
+        pix = page.get_pixmap(matrix=fitz.Matrix(dpi / 72, dpi / 72), colorspace=fitz.csRGB)
+        path = out_dir / f"bench_{k:04d}_{paper}.jpg"
+        pix.save(path, jpg_quality=85)
+        doc.close()
+        generated.append(path)
+    return generated
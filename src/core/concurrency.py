@@ -0,0 +1,4 @@
+import threading
+
+# PyMuPDF はスレッドセーフではないため、fitz の操作はこのロックで直列化する
+fitz_lock = threading.RLock()
@@ -0,0 +1,76 @@
+import hashlib
+import fitz  # PyMuPDF
+from core.concurrency import fitz_lock
+
+
+def content_hash(file_path, chunk_size=1024 * 1024):
+    """ファイル内容のハッシュ（バイト単位で同一のファイルの検出用）"""
+    h = hashlib.blake2b(digest_size=20)
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def perceptual_hash(file_path, hash_size=16):
+    """1ページ目の低解像度画像から差分ハッシュ（dHash）を計算する
+
+    再スキャンのように画素単位では異なるが見た目が同じ書類の検出に使う。
+    戻り値は (16進文字列のハッシュ, ページ数)。PDF・JPEGのどちらにも対応する。
+    """
+    with fitz_lock:
+        doc = fitz.open(file_path)
+        try:
+            page_count = len(doc)
+            if page_count == 0:
+                return None, 0
+            page = doc[0]
+            # ハッシュサイズの数倍程度の解像度でグレースケール描画する
+            width = (hash_size + 1) * 4
+            height = hash_size * 4
+            matrix = fitz.Matrix(width / page.rect.width, height / page.rect.height)
+            pix = page.get_pixmap(matrix=matrix, colorspace=fitz.csGRAY, alpha=False)
+            samples = pix.samples
+            pix_width, pix_height, stride = pix.width, pix.height, pix.stride
+        finally:
+            doc.close()
+
+    bits = dhash(samples, pix_width, pix_height, stride, hash_size)
+    return f"{bits:0{hash_size * hash_size // 4}x}", page_count
+
+
+def dhash(samples, width, height, stride, hash_size=16):
+    """グレースケール画素から差分ハッシュ（hash_size x hash_size ビットの整数）を計算する"""
+    grid = _downsample(samples, width, height, stride, hash_size + 1, hash_size)
+    bits = 0
+    for row in grid:
+        for x in range(hash_size):
+            bits = (bits << 1) | (1 if row[x] > row[x + 1] else 0)
+    return bits
+
+
+def _downsample(samples, width, height, stride, out_width, out_height):
+    """グレースケール画素をブロック平均で out_width x out_height に縮小する"""
+    grid = []
+    for gy in range(out_height):
+        y0 = gy * height // out_height
+        y1 = max(y0 + 1, (gy + 1) * height // out_height)
+        row = []
+        for gx in range(out_width):
+            x0 = gx * width // out_width
+            x1 = max(x0 + 1, (gx + 1) * width // out_width)
+            total = 0
+            for y in range(y0, y1):
+                offset = y * stride
+                total += sum(samples[offset + x0:offset + x1])
+            row.append(total / ((y1 - y0) * (x1 - x0)))
+        grid.append(row)
+    return grid
+
+
+def hamming_distance(hash_a, hash_b):
+    """16進文字列で表した2つのハッシュのビット差を返す"""
+    return (int(hash_a, 16) ^ int(hash_b, 16)).bit_count()
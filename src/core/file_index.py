@@ -0,0 +1,32 @@
+import os
+import threading
+
+
+class FileNameIndex:
+    """ファイル名からフルパスを引くための索引
+
+    最初の検索時に対象ディレクトリをそれぞれ1回だけ走査し、以降の検索は
+    メモリ上の辞書で行う。同名のファイルが複数ある場合は、先に見つかったものを返す。
+    """
+
+    def __init__(self, directories):
+        self.directories = [d for d in directories if d]
+        self._paths = None
+        self._lock = threading.Lock()
+
+    def _build(self):
+        paths = {}
+        for directory in self.directories:
+            if not os.path.isdir(directory):
+                continue
+            for root, dirs, files in os.walk(directory):
+                for file_name in files:
+                    paths.setdefault(file_name, os.path.join(root, file_name))
+        return paths
+
+    def find(self, file_name):
+        """ファイル名に一致するパスを返す。見つからない場合は None"""
+        with self._lock:
+            if self._paths is None:
+                self._paths = self._build()
+            return self._paths.get(file_name)
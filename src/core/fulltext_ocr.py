@@ -0,0 +1,220 @@
+import hashlib
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from core.llm import chat_completion
+from core.image_payload import image_content
+from core.llm_cache import get_llm_cache
+from core.page_analysis import get_page_analyzer
+from core.text_layer import usable_text
+
+FULLTEXT_HEADING = "## 全文（OCR）"
+
+
+class FulltextOCR:
+    """ページ画像をVision LLMで全文OCRする処理（OCR追加処理と取り込み時のOCRで共用）
+
+    設定は ocr_enhancer（fulltext_prompt, page_concurrency, page_cache, text_layer）を使う。
+    """
+
+    def __init__(self, config, llm, history):
+        self.config = config
+        self.llm = llm
+        self.history = history
+        # 白紙ページの判定（common.page_analysis が無効なら None）
+        self.page_analyzer = get_page_analyzer(config)
+
+    def request_page_ocr(self, image, page_num, metrics=None):
+        """指定されたページの画像（ImagePayload）からOCRテキストを (テキスト, 打ち切り理由) で取得する（失敗時は例外）"""
+        prompt = self.config['ocr_enhancer']['fulltext_prompt'].format(page_number=page_num)
+        model = self.config['common']['llm_model']
+        temperature = 0.2 # OCRの正確性を高めるため低めに設定
+
+        # 同じページ画像・プロンプト・モデルでのOCR結果があれば再利用する
+        cache = get_llm_cache(self.config)
+        cache_key = None
+        if cache is not None:
+            cache_key = cache.make_key(model, temperature, prompt, [image])
+            cached = cache.get(cache_key)
+            if cached is not None:
+                if metrics is not None:
+                    metrics.add("llm_cache_hits")
+                return cached, None
+        
+        content = [
+            {"type": "text", "text": prompt},
+            image_content(image)
+        ]
+
+        # 要約処理と同じく、LLMへの同時リクエスト数はサーバーごとに制限される（core.llm_router）
+        result, stop_reason = chat_completion(self.llm, self.config, model, content, temperature, metrics=metrics)
+        if metrics is not None:
+            metrics.add("payload_bytes", len(image.data))
+        # 繰り返しで打ち切った結果は欠けている可能性があるため、キャッシュしない
+        if cache is not None and result and stop_reason != "repetition":
+            cache.put(cache_key, result, model=model)
+        return result, stop_reason
+
+    def get_page_ocr(self, image, page_num, checkpoint=None, metrics=None):
+        """ページのOCRテキストを返す。失敗時は読み取り失敗の旨を記したテキストを返す
+
+        checkpoint に (履歴キー, シグネチャ) を渡すと、成功したページを履歴ストアに保存する。
+        出力の繰り返しで打ち切ったページは、読み取れた部分に失敗の旨を添えて返し、保存しない
+        （次回の再処理でOCRし直される）。
+        """
+        try:
+            result, stop_reason = self.request_page_ocr(image, page_num, metrics)
+        except Exception as e:
+            logging.error(f"Error during OCR for page {page_num}: {e}")
+            return f"### ページ {page_num}\n\n[[読み取り失敗: {e}]]"
+        if stop_reason == "repetition":
+            logging.error(f"OCR output for page {page_num} was cut off due to repetition.")
+            return f"{result}\n\n[[読み取り失敗: 出力の繰り返しを検出したため途中で打ち切りました]]"
+        if checkpoint is not None:
+            self.history.save_ocr_page(checkpoint[0], page_num, result, checkpoint[1])
+        return result
+
+    def page_signature(self, image, page_num):
+        """保存済みのページ結果を再利用してよいかの判定用に、ページ画像とOCR設定からシグネチャを作る"""
+        h = hashlib.sha256(image.data)
+        settings = json.dumps([
+            self.config['common']['llm_model'],
+            self.config['ocr_enhancer']['fulltext_prompt'].format(page_number=page_num)
+        ], ensure_ascii=False)
+        h.update(settings.encode('utf-8'))
+        return h.hexdigest()
+
+    def text_layer_pages(self, source, page_indices):
+        """テキストレイヤーの品質が十分なページを {ページ番号(0始まり): (テキスト, スコア)} で返す
+
+        ocr_enhancer.text_layer.enabled が有効な場合のみ使用する。
+        """
+        text_cfg = self.config['ocr_enhancer'].get('text_layer', {})
+        if not text_cfg.get('enabled', False):
+            return {}
+        min_chars = text_cfg.get('min_chars', 20)
+        min_score = text_cfg.get('min_score', 0.9)
+        min_coverage = text_cfg.get('min_coverage', 0.05)
+        pages = {}
+        for i in page_indices:
+            try:
+                text, coverage = source.text(i)
+            except Exception as e:
+                logging.warning(f"Failed to extract text layer of page {i+1}: {e}")
+                continue
+            usable, score = usable_text(text, coverage, min_chars, min_score, min_coverage)
+            if usable:
+                pages[i] = (text.strip(), score)
+        if pages:
+            logging.info(f"Using embedded text layer for {len(pages)}/{len(page_indices)} pages.")
+        return pages
+
+    def ocr_pages(self, source, page_indices, checkpoint_key=None, metrics=None, rendered=None):
+        """指定ページをOCRし、ページ順に並べたテキストのリストを返す
+
+        ocr_enhancer.page_concurrency が 2 以上の場合は複数ページを並行して問い合わせる。
+        画像化は先読みしつつも、未処理のページが同時実行数を大きく超えないよう抑える。
+        checkpoint_key を渡すと、ページごとの結果をページ画像のハッシュとともに履歴ストアに
+        保存し、画像とOCR設定が変わっていないページは前回の結果を再利用する（中断からの再開や
+        reprocess_ocr での再処理では、変更されたページと読み取りに失敗したページだけがOCRされる）。
+        テキストレイヤーを使えるページと、白紙と判定したページ（common.page_analysis）は
+        LLMに送らない。各ページの先頭には取得元を
+        HTMLコメント（<!-- ocr-source: ... -->）として記録する。
+        """
+        page_indices = list(page_indices)
+        total_pages = source.page_count
+        lookahead = self.config['common'].get('render_lookahead', 2)
+        concurrency = max(1, int(self.config['ocr_enhancer'].get('page_concurrency', 1) or 1))
+
+        stored = {}
+        if checkpoint_key is not None and self.config['ocr_enhancer'].get('page_cache', True):
+            stored = self.history.load_ocr_pages(checkpoint_key)
+
+        results = {}
+        provenance = {}
+        for i, (text, score) in self.text_layer_pages(source, page_indices).items():
+            results[i] = f"### ページ {i+1}\n\n{text}"
+            provenance[i] = f"text-layer (score {score:.2f})"
+        text_layer = len(results)
+        blank = 0
+        if self.page_analyzer is not None:
+            # 白紙のページ（両面スキャンの裏面など）はLLMに送らない
+            remaining = [i for i in page_indices if i not in results]
+            for i, profile in source.profiles(self.page_analyzer, remaining).items():
+                if profile.blank:
+                    results[i] = f"### ページ {i+1}\n\n（白紙）"
+                    provenance[i] = "blank"
+                    blank += 1
+            if blank:
+                logging.info(f"Skipping {blank} blank pages.")
+        pending = [i for i in page_indices if i not in results]
+        provenance.update((i, "llm") for i in pending)
+
+        def lookup(i, page_image):
+            """(結果の保存先 checkpoint, 再利用できる前回の結果) を返す"""
+            if checkpoint_key is None:
+                return None, None
+            signature = self.page_signature(page_image, i+1)
+            previous = stored.get(i + 1)
+            if previous is not None and previous[0] == signature:
+                return None, previous[1]
+            return (checkpoint_key, signature), None
+
+        reused = 0
+        if concurrency == 1:
+            for i, page_image in source.iter_pages(pending, lookahead, rendered=rendered):
+                checkpoint, previous = lookup(i, page_image)
+                if previous is not None:
+                    results[i] = previous
+                    reused += 1
+                    continue
+                logging.info(f"Processing page {i+1}/{total_pages}...")
+                results[i] = self.get_page_ocr(page_image, i+1, checkpoint, metrics)
+        else:
+            futures = {}
+            slots = threading.BoundedSemaphore(concurrency)
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                for i, page_image in source.iter_pages(pending, lookahead, rendered=rendered):
+                    checkpoint, previous = lookup(i, page_image)
+                    if previous is not None:
+                        results[i] = previous
+                        reused += 1
+                        continue
+                    slots.acquire()
+                    logging.info(f"Processing page {i+1}/{total_pages}...")
+                    future = executor.submit(self.get_page_ocr, page_image, i+1, checkpoint, metrics)
+                    future.add_done_callback(lambda _: slots.release())
+                    futures[i] = future
+            results.update((i, future.result()) for i, future in futures.items())
+        if reused:
+            logging.info(f"Reused stored OCR results for {reused} unchanged pages.")
+        if metrics is not None:
+            metrics.add("pages_text_layer", text_layer)
+            metrics.add("pages_reused", reused)
+            metrics.add("pages_ocr", len(pending) - reused)
+        return [f"<!-- ocr-source: {provenance[i]} -->\n{results[i]}" for i in page_indices]
+
+    def ocr_document(self, source, checkpoint_key=None, metrics=None, rendered=None):
+        """書類の先頭から fulltext_max_pages ページまでをOCRし、Markdownのセクションを返す
+
+        rendered に {ページ番号(0始まり): ImagePayload} を渡すと、そのページは画像化し直さない。
+        """
+        max_pages = self.config['ocr_enhancer'].get('fulltext_max_pages', 50)
+        total_pages = source.page_count
+        fulltext_parts = self.ocr_pages(source, range(min(total_pages, max_pages)),
+                                        checkpoint_key=checkpoint_key, metrics=metrics, rendered=rendered)
+        if checkpoint_key is not None:
+            # 原本のページが減った・上限を下げた場合に、対象外になったページの保存結果を残さない
+            self.history.prune_ocr_pages(checkpoint_key, min(total_pages, max_pages))
+        if total_pages > max_pages:
+            logging.info(f"Reached max pages limit ({max_pages}).")
+            fulltext_parts.append(f"\n\n> (注意: 設定により最大{max_pages}ページまでをOCR対象としています。)")
+
+        header = (
+            "\n---\n\n"
+            f"{FULLTEXT_HEADING}\n\n"
+            "> このセクションはAIにより画像から全文OCRされた内容です。\n"
+            "> レイアウトの忠実再現ではなく、可読性と検索性を優先しています。\n\n"
+        )
+        return header + "\n\n".join(fulltext_parts)
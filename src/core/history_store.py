@@ -0,0 +1,376 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from core.utils import resolve_project_path
+
+
+def normalize_entry(value):
+    """履歴エントリを辞書形式に揃える。古い形式（パス:パス）の文字列もサポートする"""
+    if isinstance(value, str):
+        return {"md_path": value, "ocr_completed": False}
+    return value
+
+
+class HistoryStore:
+    """処理済み履歴の保存先の共通インターフェース
+
+    エントリは「原本ファイルの絶対パス」をキーとした辞書
+    （md_path, ocr_completed など）。dict と同様に `key in store`、
+    `store[key]`、`store[key] = entry` で扱える。
+    """
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def put(self, key, entry):
+        """エントリを丸ごと置き換える（存在しなければ追加する）"""
+        raise NotImplementedError
+
+    def update(self, key, **fields):
+        """既存エントリの一部の項目だけを更新する（存在しなければ追加する）"""
+        raise NotImplementedError
+
+    def items(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def completed_md_paths(self):
+        """全文OCRが完了したノート（md_path）の集合を返す"""
+        return {
+            entry["md_path"]
+            for _, entry in self.items()
+            if isinstance(entry, dict) and entry.get("ocr_completed") and entry.get("md_path")
+        }
+
+    def record_fingerprint(self, key, content_hash, phash=None, page_count=None):
+        """重複検出用に、ファイル内容のハッシュと知覚ハッシュを記録する"""
+        raise NotImplementedError
+
+    def keys_by_content_hash(self, content_hash):
+        """同じ内容ハッシュを持つファイルのキーを返す"""
+        return [key for key, h, _, _ in self.fingerprints() if h == content_hash]
+
+    def fingerprints(self):
+        """(キー, 内容ハッシュ, 知覚ハッシュ, ページ数) のリストを返す"""
+        raise NotImplementedError
+
+    def save_ocr_page(self, key, page, text, signature):
+        """全文OCRの1ページ分の結果を、ページ画像とOCR設定のシグネチャとともに保存する"""
+        raise NotImplementedError
+
+    def load_ocr_pages(self, key):
+        """保存済みのページ結果を {ページ番号: (シグネチャ, テキスト)} で返す"""
+        raise NotImplementedError
+
+    def prune_ocr_pages(self, key, page_count):
+        """page_count より後ろのページの保存結果を削除する（原本のページが減った場合など）"""
+        raise NotImplementedError
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        entry = self.get(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry
+
+    def __setitem__(self, key, entry):
+        self.put(key, entry)
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """SQLite による履歴ストア
+
+    エントリ単位でアトミックに更新されるため、要約処理とOCR追加処理が
+    別プロセスで同時に動いても互いの更新を上書きしない。
+    """
+
+    def __init__(self, db_path, legacy_json_path=None):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        with self._transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                " key TEXT PRIMARY KEY,"
+                " entry TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS fingerprints ("
+                " key TEXT PRIMARY KEY,"
+                " content_hash TEXT NOT NULL,"
+                " phash TEXT,"
+                " page_count INTEGER)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_fingerprints_content ON fingerprints (content_hash)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ocr_pages ("
+                " key TEXT NOT NULL,"
+                " page INTEGER NOT NULL,"
+                " signature TEXT NOT NULL,"
+                " text TEXT NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " PRIMARY KEY (key, page))"
+            )
+        if legacy_json_path:
+            self.migrate_from_json(legacy_json_path)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # スレッドごとに接続を持ち、ロック競合時は最大30秒待つ
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._connect())
+
+    def migrate_from_json(self, json_path):
+        """既存の history.json を一度だけ取り込む（SQLite側のエントリを優先する）"""
+        json_path = Path(json_path)
+        if not json_path.exists():
+            return
+        with self._transaction() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE name = 'migrated_from_json'").fetchone()
+            if row:
+                return
+            try:
+                with open(json_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except Exception as e:
+                logging.warning(f"Failed to load history for migration: {e}")
+                return
+            now = time.time()
+            conn.executemany(
+                "INSERT OR IGNORE INTO history (key, entry, updated_at) VALUES (?, ?, ?)",
+                [(key, json.dumps(normalize_entry(value), ensure_ascii=False), now) for key, value in data.items()]
+            )
+            conn.execute(
+                "INSERT INTO meta (name, value) VALUES ('migrated_from_json', ?)",
+                (str(json_path),)
+            )
+        logging.info(f"Migrated {len(data)} history entries from {json_path} to {self.db_path}")
+
+    def get(self, key, default=None):
+        row = self._connect().execute("SELECT entry FROM history WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def put(self, key, entry):
+        with self._transaction() as conn:
+            self._upsert(conn, key, entry)
+
+    def update(self, key, **fields):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT entry FROM history WHERE key = ?", (key,)).fetchone()
+            entry = json.loads(row[0]) if row else {"ocr_completed": False}
+            entry.update(fields)
+            self._upsert(conn, key, entry)
+        return entry
+
+    def _upsert(self, conn, key, entry):
+        conn.execute(
+            "INSERT INTO history (key, entry, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET entry = excluded.entry, updated_at = excluded.updated_at",
+            (key, json.dumps(entry, ensure_ascii=False), time.time())
+        )
+
+    def items(self):
+        rows = self._connect().execute("SELECT key, entry FROM history").fetchall()
+        return [(key, json.loads(entry)) for key, entry in rows]
+
+    def record_fingerprint(self, key, content_hash, phash=None, page_count=None):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO fingerprints (key, content_hash, phash, page_count) VALUES (?, ?, ?, ?)",
+                (key, content_hash, phash, page_count)
+            )
+
+    def keys_by_content_hash(self, content_hash):
+        rows = self._connect().execute(
+            "SELECT key FROM fingerprints WHERE content_hash = ?", (content_hash,)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def fingerprints(self):
+        return self._connect().execute(
+            "SELECT key, content_hash, phash, page_count FROM fingerprints"
+        ).fetchall()
+
+    def save_ocr_page(self, key, page, text, signature):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO ocr_pages (key, page, signature, text, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (key, page, signature, text, time.time())
+            )
+
+    def load_ocr_pages(self, key):
+        rows = self._connect().execute(
+            "SELECT page, signature, text FROM ocr_pages WHERE key = ?", (key,)
+        ).fetchall()
+        return {page: (signature, text) for page, signature, text in rows}
+
+    def prune_ocr_pages(self, key, page_count):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM ocr_pages WHERE key = ? AND page > ?", (key, page_count))
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE で書き込みロックを取得し、終了時にコミット／ロールバックする"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+        return False
+
+
+class JSONHistoryStore(HistoryStore):
+    """従来の history.json 形式の履歴ストア
+
+    更新のたびにファイル全体を書き直すため、件数が多い場合は SQLite を推奨する。
+    書き込み前にファイルを読み直してマージし、他プロセスの更新を消さないようにしている。
+    """
+
+    def __init__(self, json_path):
+        self.json_path = Path(json_path)
+        self.json_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._data = self._load()
+
+    def _load(self):
+        if self.json_path.exists():
+            try:
+                with open(self.json_path, "r", encoding="utf-8") as f:
+                    return {key: normalize_entry(value) for key, value in json.load(f).items()}
+            except Exception as e:
+                logging.warning(f"Failed to load history: {e}")
+        return {}
+
+    def _modify(self, key, modify):
+        """ファイルを読み直して1件を更新し、ファイル全体を書き直す"""
+        with self._lock:
+            data = self._load()
+            entry = modify(data.get(key))
+            data[key] = entry
+            self._data = data
+            tmp_path = self.json_path.with_name(f"{self.json_path.name}.tmp")
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False, indent=4)
+                os.replace(tmp_path, self.json_path)
+            except Exception as e:
+                logging.error(f"Failed to save history: {e}")
+            return entry
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def put(self, key, entry):
+        self._modify(key, lambda _: entry)
+
+    def update(self, key, **fields):
+        def merge(entry):
+            entry = dict(entry or {"ocr_completed": False})
+            entry.update(fields)
+            return entry
+        return self._modify(key, merge)
+
+    def items(self):
+        with self._lock:
+            return list(self._data.items())
+
+    def record_fingerprint(self, key, content_hash, phash=None, page_count=None):
+        # JSON形式ではエントリ内の項目として保存する
+        self.update(key, content_hash=content_hash, phash=phash, page_count=page_count)
+
+    def fingerprints(self):
+        with self._lock:
+            return [
+                (key, entry["content_hash"], entry.get("phash"), entry.get("page_count"))
+                for key, entry in self._data.items()
+                if isinstance(entry, dict) and entry.get("content_hash")
+            ]
+
+    def save_ocr_page(self, key, page, text, signature):
+        def add_page(entry):
+            entry = dict(entry or {"ocr_completed": False})
+            pages = dict(entry.get("ocr_pages") or {})
+            pages[str(page)] = {"signature": signature, "text": text}
+            entry["ocr_pages"] = pages
+            return entry
+        self._modify(key, add_page)
+
+    def load_ocr_pages(self, key):
+        with self._lock:
+            pages = (self._data.get(key) or {}).get("ocr_pages") or {}
+            return {int(page): (p.get("signature"), p["text"]) for page, p in pages.items()}
+
+    def prune_ocr_pages(self, key, page_count):
+        with self._lock:
+            pages = (self._data.get(key) or {}).get("ocr_pages") or {}
+            if all(int(page) <= page_count for page in pages):
+                return
+
+        def remove_pages(entry):
+            entry = dict(entry or {"ocr_completed": False})
+            pages = entry.get("ocr_pages") or {}
+            entry["ocr_pages"] = {page: p for page, p in pages.items() if int(page) <= page_count}
+            return entry
+        self._modify(key, remove_pages)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_history_store(config):
+    """設定に応じた履歴ストアを返す（同じプロセス内では同一インスタンスを共有する）
+
+    common.history_backend が "sqlite"（既定）の場合は common.history_db を使用し、
+    初回のみ common.history_file（history.json）の内容を取り込む。
+    "json" の場合は従来通り history.json を直接読み書きする。
+    """
+    common = config.get('common', {})
+    backend = common.get('history_backend', 'sqlite')
+    json_path = resolve_project_path(common.get('history_file') or 'data/history.json')
+
+    with _stores_lock:
+        if backend == 'json':
+            cache_key = ('json', str(json_path))
+            if cache_key not in _stores:
+                _stores[cache_key] = JSONHistoryStore(json_path)
+        else:
+            db_path = resolve_project_path(common.get('history_db') or 'data/history.sqlite3')
+            cache_key = ('sqlite', str(db_path))
+            if cache_key not in _stores:
+                _stores[cache_key] = SQLiteHistoryStore(db_path, legacy_json_path=json_path)
+        return _stores[cache_key]
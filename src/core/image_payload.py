@@ -0,0 +1,58 @@
+import base64
+import logging
+from pathlib import Path
+
+_MIME_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+}
+
+
+class ImagePayload:
+    """AIに送信する画像データ（メモリ上のエンコード済みバイト列とMIMEタイプ）
+
+    ページ画像を一時ファイルに書き出して読み直すことなく、
+    レンダリング結果や原本ファイルのバイト列から直接データURLを組み立てる。
+    """
+
+    __slots__ = ("data", "mime", "name")
+
+    def __init__(self, data, mime="image/png", name="image"):
+        self.data = data
+        self.mime = mime
+        self.name = name
+
+    @classmethod
+    def from_pixmap(cls, pix, name):
+        """fitz.Pixmap をPNGとしてメモリ上でエンコードする"""
+        return cls(pix.tobytes("png"), "image/png", name)
+
+    @classmethod
+    def from_file(cls, path):
+        """画像ファイルをそのまま読み込む（拡張子からMIMEタイプを判定する）"""
+        path = Path(path)
+        mime = _MIME_TYPES.get(path.suffix.lower(), "image/png")
+        return cls(path.read_bytes(), mime, path.stem)
+
+    def to_data_url(self):
+        """リクエストに埋め込むための data URL を返す"""
+        return f"data:{self.mime};base64,{base64.b64encode(self.data).decode('ascii')}"
+
+    def save(self, directory):
+        """デバッグ用に画像を書き出す（keep_temp_files が有効な場合に使用）"""
+        extension = ".jpg" if self.mime == "image/jpeg" else ".png"
+        out_path = Path(directory) / f"{self.name}{extension}"
+        try:
+            out_path.write_bytes(self.data)
+        except OSError as e:
+            logging.warning(f"Failed to save temp image {out_path}: {e}")
+        return out_path
+
+
+def image_content(payload):
+    """ImagePayload をチャットリクエストの image_url 要素に変換する"""
+    return {
+        "type": "image_url",
+        "image_url": {"url": payload.to_data_url()}
+    }
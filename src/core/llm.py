@@ -0,0 +1,305 @@
+import json
+import logging
+import re
+import time
+import openai
+
+
+class LLMTimeoutError(Exception):
+    """LLMの応答が期限内に始まらなかった、または生成が期限内に終わらなかった"""
+
+
+# 送信先のサーバーの障害とみなす例外（応答内容の問題やリクエストの誤りは含めない）
+_BACKEND_ERRORS = (openai.APIConnectionError, openai.InternalServerError, LLMTimeoutError)
+# JSONのコードブロックの開始（この直後の括弧はJSONの開始とみなす）
+_JSON_FENCE = re.compile(r"```json\s*$", re.IGNORECASE)
+
+
+def stream_settings(config):
+    """common.llm_stream の設定を既定値で補って返す"""
+    stream_cfg = config.get('common', {}).get('llm_stream', {})
+    return {
+        "enabled": stream_cfg.get('enabled', True),
+        # 最初のトークンが届くまで（画像の読み込みを含む）の待ち時間の上限（秒）
+        "first_token_timeout": stream_cfg.get('first_token_timeout', 180),
+        # 生成全体の時間の上限（秒）
+        "max_generation_seconds": stream_cfg.get('max_generation_seconds', 600),
+        # 生成するトークン数の上限（未設定ならサーバーの既定値）
+        "max_tokens": stream_cfg.get('max_tokens'),
+        # 同じ文字列の繰り返しがこの文字数続いたら生成を打ち切る（0で無効）
+        "repetition_chars": stream_cfg.get('repetition_chars', 2000),
+        # これより短い周期の繰り返し（空の表の行など）はループとみなさない
+        "repetition_min_period": stream_cfg.get('repetition_min_period', 16),
+        # 途中で打ち切った後、トークン数（usage）の報告を待つ時間の上限（秒、0で待たない）
+        "usage_wait_seconds": stream_cfg.get('usage_wait_seconds', 2),
+        # 期限切れ・接続エラー時の再試行回数（停止したサーバーを何度も待たないよう少なめにする）
+        "max_retries": stream_cfg.get('max_retries', 1),
+    }
+
+
+def chat_completion(router, config, model, content, temperature, expect_json=False, metrics=None):
+    """LLMに1回問い合わせ、(応答テキスト, 打ち切り理由) を返す
+
+    送信先は router（LLMRouter）が選び、サーバーごとの同時リクエスト数もそこで制限される。
+    接続エラー・期限切れで失敗した場合、他に正常なサーバーがあれば1回だけそちらで再試行する。
+    ストリーミング（既定）では、最初のトークンまでの待ち時間と生成全体の時間に
+    それぞれ期限を設け、超えた場合は LLMTimeoutError を送出する。
+    expect_json が True の場合は最初のJSONオブジェクトが、"array" の場合は最初のJSON配列が
+    閉じた時点で生成を打ち切る。
+    同じ文字列を繰り返し出力し続ける（ループした）場合も、その時点で打ち切る。
+    打ち切り理由は最後まで生成した場合は None、JSONが閉じた場合は "json_complete"、
+    ループした場合は "repetition"（応答が欠けている可能性があるため、呼び出し側で失敗として扱う）。
+    metrics（DocumentMetrics）を渡すと、待ち時間・応答時間・トークン数を記録する。
+    """
+    settings = stream_settings(config)
+    request = {
+        "messages": [{"role": "user", "content": content}],
+        "temperature": temperature,
+        "timeout": openai.Timeout(settings["max_generation_seconds"], connect=30,
+                                  read=settings["first_token_timeout"]),
+    }
+    if settings["max_tokens"]:
+        request["max_tokens"] = settings["max_tokens"]
+
+    started = time.perf_counter()
+    failed_backend = None
+    while True:
+        backend = router.acquire(exclude=failed_backend)
+        slot_acquired = time.perf_counter()
+        client = backend.client.with_options(max_retries=settings["max_retries"])
+        request["model"] = backend.model or model
+        try:
+            if settings["enabled"]:
+                result, usage, first_token, stop_reason, chunks = _consume_stream(client, request, settings, expect_json)
+            else:
+                response = client.chat.completions.create(**request)
+                result, usage, first_token, stop_reason = response.choices[0].message.content, response.usage, None, None
+                chunks = None
+        except _BACKEND_ERRORS as e:
+            router.release(backend, failed=True)
+            if failed_backend is not None or not router.has_alternative(backend):
+                raise
+            logging.warning(f"LLM request to {backend.base_url} failed ({e}). Retrying on another backend.")
+            failed_backend = backend
+            if metrics is not None:
+                metrics.add("llm_failovers")
+            continue
+        except BaseException:
+            router.release(backend)
+            raise
+        router.release(backend)
+        break
+
+    if metrics is not None:
+        metrics.add_time("llm_queue", slot_acquired - started)
+        metrics.add_time("llm", time.perf_counter() - slot_acquired)
+        if first_token is not None:
+            metrics.add_time("llm_first_token", first_token - slot_acquired)
+        metrics.add("llm_requests")
+        if stop_reason:
+            metrics.add(f"llm_stopped_{stop_reason}")
+        if usage is not None:
+            metrics.record_usage(usage)
+        else:
+            # トークン数が報告されなかった問い合わせは、件数と受信したチャンク数（≒生成トークン数）で残す
+            metrics.add("llm_usage_unavailable")
+            if chunks:
+                metrics.add("completion_tokens_estimated", chunks)
+    return result, stop_reason
+
+
+def _consume_stream(client, request, settings, expect_json):
+    """ストリーミング応答を読み、(テキスト, usage, 最初のトークンの受信時刻, 打ち切り理由, 受信したチャンク数) を返す
+
+    途中で打ち切った場合も、usage_wait_seconds の間は残りの応答を読み捨てて usage の報告を待つ。
+    期限内に届かなかった場合、usage は None になる。
+    """
+    started = time.perf_counter()
+    first_token_deadline = started + settings["first_token_timeout"]
+    generation_deadline = started + settings["max_generation_seconds"]
+    try:
+        stream = client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **request)
+    except openai.APITimeoutError as e:
+        raise LLMTimeoutError(f"No response within {settings['first_token_timeout']}s") from e
+
+    parts = []
+    usage = None
+    first_token = None
+    chunks = 0
+    json_scanner = None
+    if expect_json:
+        json_scanner = JSONObjectScanner("[" if expect_json == "array" else "{")
+    repetition = None
+    if settings["repetition_chars"]:
+        repetition = RepetitionGuard(settings["repetition_chars"], min_period=settings["repetition_min_period"])
+    try:
+        for chunk in stream:
+            now = time.perf_counter()
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                # 読み込み中の keep-alive などで最初のトークンが届かない場合
+                if first_token is None and now > first_token_deadline:
+                    raise LLMTimeoutError(f"No token received within {settings['first_token_timeout']}s")
+                continue
+            if first_token is None:
+                first_token = now
+            parts.append(delta)
+            chunks += 1
+
+            if json_scanner is not None and json_scanner.feed(delta):
+                # JSONの後に続く説明文などは待たない
+                logging.debug("JSON object complete. Stopping generation early.")
+                usage = usage or _wait_for_usage(stream, settings["usage_wait_seconds"])
+                return json_scanner.complete_text(), usage, first_token, "json_complete", chunks
+            if repetition is not None and repetition.feed(delta):
+                logging.warning(f"Repeated output detected ({repetition.period} chars repeating). Stopping generation.")
+                usage = usage or _wait_for_usage(stream, settings["usage_wait_seconds"])
+                return repetition.trimmed_text(), usage, first_token, "repetition", chunks
+            if now > generation_deadline:
+                raise LLMTimeoutError(f"Generation did not finish within {settings['max_generation_seconds']}s")
+    except openai.APITimeoutError as e:
+        if first_token is None:
+            raise LLMTimeoutError(f"No token received within {settings['first_token_timeout']}s") from e
+        raise LLMTimeoutError(f"Generation stalled: {e}") from e
+    finally:
+        # 途中で打ち切った場合も接続を閉じ、サーバー側の生成を止める
+        stream.close()
+    return "".join(parts), usage, first_token, None, chunks
+
+
+def _wait_for_usage(stream, seconds):
+    """打ち切った後のストリームを読み捨て、usage が届けば返す（seconds を過ぎたら None）
+
+    期限はチャンクを受け取るたびに確認するため、生成が止まっている場合は読み込みの期限まで待つことがある。
+    """
+    if seconds <= 0:
+        return None
+    deadline = time.perf_counter() + seconds
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage", None):
+                return chunk.usage
+            if time.perf_counter() > deadline:
+                break
+    except openai.APIError as e:
+        logging.debug(f"Stream ended before usage was reported: {e}")
+    return None
+
+
+class JSONObjectScanner:
+    """ストリーミング中のテキストから、最初のJSONオブジェクト（opener が "[" なら配列）が閉じた位置を検出する
+
+    前置きの文中の括弧（「以下の{結果}です」など）で打ち切らないよう、JSONの開始とみなすのは
+    行頭（空白のみを挟む）か ```json の直後にある opener だけにする。括弧が閉じた時点で
+    json.loads() で解釈できなければ、次の候補を探し続ける。
+    """
+
+    def __init__(self, opener="{"):
+        self.opener = opener
+        self.closer = "]" if opener == "[" else "}"
+        self.text = ""
+        self.end = None
+        self._pos = 0
+        self._start = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, delta):
+        """テキストを追加し、JSONオブジェクトが完結したら True を返す"""
+        self.text += delta
+        while self._pos < len(self.text):
+            ch = self.text[self._pos]
+            self._pos += 1
+            if self._start is None:
+                if ch == self.opener and self._at_json_start(self._pos - 1):
+                    self._start = self._pos - 1
+                    self._depth = 1
+                    self._in_string = False
+                    self._escaped = False
+                continue
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == self.opener:
+                self._depth += 1
+            elif ch == self.closer:
+                self._depth -= 1
+                if self._depth == 0:
+                    if self._parses(self.text[self._start:self._pos]):
+                        self.end = self._pos
+                        return True
+                    # JSONではなかったため、候補の直後から探し直す
+                    self._pos = self._start + 1
+                    self._start = None
+        return False
+
+    def _at_json_start(self, index):
+        """index の opener が行頭（空白のみを挟む）か ```json の直後にあるか"""
+        line = self.text[self.text.rfind("\n", 0, index) + 1:index]
+        return not line.strip() or _JSON_FENCE.search(line) is not None
+
+    def _parses(self, candidate):
+        try:
+            value = json.loads(candidate)
+        except ValueError:
+            return False
+        return isinstance(value, list if self.opener == "[" else dict)
+
+    def complete_text(self):
+        """閉じたJSONまでのテキスト（コードブロックで始まる場合は閉じておく）"""
+        text = self.text[:self.end]
+        if "```" in text[:self._start]:
+            text += "\n```"
+        return text
+
+
+class RepetitionGuard:
+    """出力の末尾が短い文字列の繰り返しになっていないかを監視する
+
+    末尾 window 文字が周期 period（min_period〜max_period 文字）の繰り返しになった時点で
+    ループしたとみなす。空の表の行（"| | |"）のような短い周期の繰り返しは正当な出力にも
+    現れるため対象にしない。確認は一定の文字数が追加されるごとに行う。
+    """
+
+    def __init__(self, window=2000, min_period=16, max_period=200, check_every=128):
+        self.window = window
+        self.min_period = min_period
+        self.max_period = min(max_period, window // 3)
+        self.check_every = check_every
+        self.text = ""
+        self.period = None
+        self._unchecked = 0
+
+    def feed(self, delta):
+        self.text += delta
+        self._unchecked += len(delta)
+        if self._unchecked < self.check_every or len(self.text) < self.window:
+            return False
+        self._unchecked = 0
+        tail = self.text[-self.window:]
+        for period in range(1, self.max_period + 1):
+            if tail[period:] == tail[:-period]:
+                # 最初に一致したものが基本周期（それより長い周期はその倍数になる）
+                if period < self.min_period:
+                    return False
+                self.period = period
+                return True
+        return False
+
+    def trimmed_text(self):
+        """繰り返し部分を1回分だけ残したテキスト"""
+        text = self.text
+        period = self.period
+        end = len(text)
+        while end - period * 2 >= 0 and text[end - period:end] == text[end - period * 2:end - period]:
+            end -= period
+        return text[:end]
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from core.utils import resolve_project_path
+
+
+class LLMCache:
+    """LLM応答のディスクキャッシュ（入力内容のハッシュをキーとする）
+
+    画像のバイト列・プロンプト・モデル・temperature が同じであれば、
+    再処理時にもLLMへ問い合わせず保存済みの応答を再利用する。
+    最終利用から max_age_seconds を過ぎたエントリと、合計サイズが max_bytes を
+    超えた分の古いエントリは削除される。
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024, max_age_seconds=90 * 86400):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self.prune()
+
+    @staticmethod
+    def make_key(model, temperature, prompt, images=(), image_labels=None):
+        """リクエスト内容からキャッシュキー（SHA-256）を計算する"""
+        h = hashlib.sha256()
+        request = [model, temperature, prompt]
+        # ラベルのない従来のリクエストはキーが変わらないようにする
+        if image_labels:
+            request.append(list(image_labels))
+        h.update(json.dumps(request, ensure_ascii=False).encode('utf-8'))
+        for image in images:
+            h.update(f"\0{image.mime}\0{len(image.data)}\0".encode('ascii'))
+            h.update(image.data)
+        return h.hexdigest()
+
+    def _entry_path(self, key):
+        return self.directory / key[:2] / f"{key}.json"
+
+    def get(self, key):
+        """キャッシュ済みの応答を返す。存在しない・期限切れの場合は None"""
+        path = self._entry_path(key)
+        try:
+            stat = path.stat()
+            if time.time() - stat.st_mtime > self.max_age_seconds:
+                path.unlink()
+                raise FileNotFoundError(path)
+            with open(path, "r", encoding="utf-8") as f:
+                response = json.load(f)["response"]
+            # 最終利用日時として mtime を更新する（LRU方式の削除に使用）
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return response
+
+    def put(self, key, response, model=None):
+        """応答を保存する（一時ファイル経由で置き換えるため、読み込み中でも安全）"""
+        path = self._entry_path(key)
+        try:
+            path.parent.mkdir(exist_ok=True)
+            tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"model": model, "created": time.time(), "response": response}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            size = path.stat().st_size
+        except OSError as e:
+            logging.warning(f"Failed to write LLM cache entry: {e}")
+            return
+        with self._lock:
+            self.stores += 1
+            self._total_bytes += size
+            over_limit = self._total_bytes > self.max_bytes
+        if over_limit:
+            self.prune()
+
+    def prune(self):
+        """期限切れのエントリと、容量上限を超えた分の古いエントリを削除する"""
+        now = time.time()
+        entries = []
+        for path in self.directory.glob("*/*.json"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.max_age_seconds:
+                self._remove(path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
+        with self._lock:
+            self._total_bytes = total
+
+    def _remove(self, path):
+        try:
+            path.unlink()
+        except OSError:
+            return
+        with self._lock:
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size_bytes": self._total_bytes,
+            }
+
+    def log_stats(self):
+        s = self.stats()
+        logging.info(
+            f"LLM cache: {s['hits']} hits, {s['misses']} misses (hit rate {s['hit_rate']:.0%}), "
+            f"{s['stores']} stored, {s['evictions']} evicted, {s['size_bytes'] / 1024 / 1024:.1f} MB"
+        )
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_llm_cache(config):
+    """設定に応じたプロセス共通のキャッシュを返す。無効化されている場合は None"""
+    global _cache
+    cache_cfg = config.get('common', {}).get('llm_cache', {})
+    if not cache_cfg.get('enabled', True):
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMCache(
+                resolve_project_path(cache_cfg.get('directory', 'data/llm_cache')),
+                max_bytes=int(cache_cfg.get('max_size_mb', 512) * 1024 * 1024),
+                max_age_seconds=cache_cfg.get('max_age_days', 90) * 86400,
+            )
+        return _cache
+
+
+def log_llm_cache_stats():
+    """実行終了時にキャッシュのヒット率などを出力する"""
+    if _cache is not None:
+        _cache.log_stats()
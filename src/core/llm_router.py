@@ -0,0 +1,156 @@
+import logging
+import threading
+import time
+import openai
+
+
+class LLMBackend:
+    """OpenAI互換のLLMサーバー1台分の接続と状態
+
+    クライアント（HTTP接続プール）は要約・全文OCRのすべての処理で共有し、接続を使い回す。
+    """
+
+    def __init__(self, base_url, weight=1.0, max_concurrency=1, model=None):
+        self.base_url = base_url
+        self.weight = max(0.01, float(weight))
+        self.max_concurrency = max(1, int(max_concurrency))
+        # サーバーごとにモデル名が異なる場合の上書き（省略時は common.llm_model）
+        self.model = model
+        # 接続プールは openai の既定のクライアントを使う（httpx を直接の依存関係にしないため）。
+        # 同時リクエスト数は LLMRouter が max_concurrency までに抑えるので、プールの上限は既定のままでよい
+        self.client = openai.OpenAI(base_url=base_url, api_key="lm-studio",
+                                    http_client=openai.DefaultHttpxClient())
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = None
+        self.probing = False
+
+    @property
+    def healthy(self):
+        return self.ejected_until is None
+
+
+class LLMRouter:
+    """複数のLLMサーバーにリクエストを振り分ける
+
+    重みあたりの処理中リクエスト数が最も少ないサーバーを選び、各サーバーの同時実行数は
+    max_concurrency までに制限する（空きがなければ待つ）。接続エラー・サーバーエラーが
+    eject_after_failures 回続いたサーバーは切り離し、probe_interval 秒ごとにモデル一覧の
+    取得で復旧を確認する。すべてのサーバーが切り離されている場合は、待ち続けずに
+    切り離し中のサーバーへ送信する（失敗は呼び出し側にそのまま返る）。
+    """
+
+    def __init__(self, backends, eject_after_failures=2, probe_interval=30):
+        self.backends = backends
+        self.eject_after_failures = max(1, int(eject_after_failures))
+        self.probe_interval = probe_interval
+        self._condition = threading.Condition()
+
+    def acquire(self, exclude=None):
+        """リクエスト1件分の実行枠をいずれかのサーバーに確保する（終わったら release() を呼ぶ）
+
+        exclude に渡したサーバーは、他に使えるサーバーがある限り選ばない（別サーバーでの再試行用）。
+        """
+        with self._condition:
+            while True:
+                self._start_probes()
+                healthy = [b for b in self.backends if b.healthy]
+                candidates = [b for b in healthy if b is not exclude] or healthy or self.backends
+                available = [b for b in candidates if b.outstanding < b.max_concurrency]
+                if available:
+                    backend = min(available, key=lambda b: (b.outstanding + 1) / b.weight)
+                    backend.outstanding += 1
+                    backend.requests += 1
+                    return backend
+                # 切り離したサーバーの復旧確認のため、一定時間ごとに起きる
+                self._condition.wait(timeout=self.probe_interval)
+
+    def release(self, backend, failed=False):
+        """実行枠を返す。failed は接続エラー・期限切れなど、サーバーの障害で失敗した場合に True"""
+        with self._condition:
+            backend.outstanding -= 1
+            if failed:
+                backend.failures += 1
+                backend.consecutive_failures += 1
+                if backend.healthy and backend.consecutive_failures >= self.eject_after_failures:
+                    backend.ejected_until = time.monotonic() + self.probe_interval
+                    logging.warning(f"LLM backend {backend.base_url} failed {backend.consecutive_failures} times "
+                                    f"in a row. Ejecting it for {self.probe_interval}s.")
+            else:
+                backend.consecutive_failures = 0
+            self._condition.notify_all()
+
+    def _start_probes(self):
+        """切り離し期間を過ぎたサーバーの復旧確認を別スレッドで始める（_condition を保持して呼ぶ）"""
+        now = time.monotonic()
+        for backend in self.backends:
+            if backend.healthy or backend.probing or backend.ejected_until > now:
+                continue
+            backend.probing = True
+            threading.Thread(target=self._probe, args=(backend,), name="llm-probe", daemon=True).start()
+
+    def _probe(self, backend):
+        try:
+            backend.client.with_options(max_retries=0, timeout=10).models.list()
+            ok = True
+        except Exception as e:
+            logging.info(f"LLM backend {backend.base_url} is still unavailable: {e}")
+            ok = False
+        with self._condition:
+            backend.probing = False
+            if ok:
+                backend.ejected_until = None
+                backend.consecutive_failures = 0
+                logging.info(f"LLM backend {backend.base_url} is back. Resuming requests.")
+            else:
+                backend.ejected_until = time.monotonic() + self.probe_interval
+            self._condition.notify_all()
+
+    def has_alternative(self, backend):
+        """backend 以外に正常なサーバーがあるか"""
+        with self._condition:
+            return any(b.healthy for b in self.backends if b is not backend)
+
+    def log_stats(self):
+        if len(self.backends) < 2:
+            return
+        with self._condition:
+            for b in self.backends:
+                state = "healthy" if b.healthy else "ejected"
+                logging.info(f"LLM backend {b.base_url}: {b.requests} requests, {b.failures} failures ({state})")
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_llm_router(config):
+    """設定に応じたプロセス共通のルーターを返す
+
+    common.llm_backends が未設定の場合は、lm_studio_base_url の1台を
+    common.max_concurrent_llm_requests の同時実行数で使う。
+    """
+    global _router
+    with _router_lock:
+        if _router is None:
+            common = config['common']
+            backends_cfg = common.get('llm_backends') or [{
+                "base_url": common['lm_studio_base_url'],
+                "max_concurrency": common.get('max_concurrent_llm_requests', 1) or 1,
+            }]
+            routing_cfg = common.get('llm_routing', {})
+            _router = LLMRouter(
+                [LLMBackend(b['base_url'], b.get('weight', 1), b.get('max_concurrency', 1), b.get('model'))
+                 for b in backends_cfg],
+                eject_after_failures=routing_cfg.get('eject_after_failures', 2),
+                probe_interval=routing_cfg.get('probe_interval', 30),
+            )
+        return _router
+
+
+def log_llm_router_stats():
+    """実行終了時にサーバーごとのリクエスト数を出力する（複数台の場合のみ）"""
+    if _router is not None:
+        _router.log_stats()
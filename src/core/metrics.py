@@ -0,0 +1,237 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from core.utils import resolve_project_path
+
+# JSON Lines に書き出さない状態（件数のみ集計する）
+_UNLOGGED_STATUSES = ("skipped", "ignored")
+
+
+class DocumentMetrics:
+    """1書類分の工程別の処理時間と計数（トークン数・送信バイト数など）
+
+    ページの画像化やページ単位のOCRは別スレッドで行われるため、スレッドセーフにしている。
+    """
+
+    def __init__(self, recorder, kind, path):
+        self.recorder = recorder
+        self.kind = kind
+        self.path = str(path)
+        self.status = None
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        """with ブロックの経過時間を工程 name の時間に加算する"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_usage(self, usage):
+        """LLM応答の usage（トークン数）を加算する"""
+        if usage is None:
+            return
+        self.add("prompt_tokens", getattr(usage, "prompt_tokens", 0) or 0)
+        self.add("completion_tokens", getattr(usage, "completion_tokens", 0) or 0)
+        # サーバーのプロンプトキャッシュから読み込まれたトークン数（報告するサーバーのみ）
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) if details is not None else None
+        if cached is not None:
+            self.add("prompt_cached_tokens", cached)
+            self.add("prompt_tokens_cache_reported", getattr(usage, "prompt_tokens", 0) or 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.status = "error"
+        self.recorder.finish(self)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "timestamp": datetime.now().isoformat(timespec="seconds"),
+                "kind": self.kind,
+                "path": self.path,
+                "status": self.status or "processed",
+                "seconds": round(time.perf_counter() - self._started, 4),
+                "stages": {name: round(seconds, 4) for name, seconds in self.stages.items()},
+                "counters": dict(self.counters),
+            }
+
+
+def split_batch_metrics(batch, documents):
+    """複数の書類をまとめた問い合わせの計測結果（batch）を、各書類に均等に割り振る
+
+    時間は等分し、計数は合計が変わらないよう整数で割り振る（余りは先頭の書類から1ずつ加える）。
+    """
+    if not documents:
+        return
+    count = len(documents)
+    with batch._lock:
+        stages = dict(batch.stages)
+        counters = dict(batch.counters)
+    for i, metrics in enumerate(documents):
+        for name, seconds in stages.items():
+            metrics.add_time(name, seconds / count)
+        for name, value in counters.items():
+            share, remainder = divmod(value, count)
+            metrics.add(name, share + (1 if i < remainder else 0))
+
+
+class MetricsRecorder:
+    """書類ごとの計測結果を JSON Lines に追記し、実行全体の集計を保持する
+
+    jsonl_path が None の場合はファイルに書き出さず、集計のみを行う。
+    集計結果は write_prometheus() で Prometheus の textfile collector 形式に書き出す。
+    """
+
+    def __init__(self, jsonl_path=None, prometheus_dir=None):
+        self.jsonl_path = Path(jsonl_path) if jsonl_path else None
+        self.prometheus_dir = Path(prometheus_dir) if prometheus_dir else None
+        self._lock = threading.Lock()
+        # Prometheus 形式の書き出しを1スレッドずつ行うためのロック（集計中の記録は止めない）
+        self._write_lock = threading.Lock()
+        self._started_at = time.time()
+        self._documents = {}
+        self._stage_seconds = {}
+        self._counters = {}
+        if self.jsonl_path:
+            self.jsonl_path.parent.mkdir(parents=True, exist_ok=True)
+
+    def document(self, kind, path):
+        """1書類分の計測を開始する（with ブロックを抜けると記録される）"""
+        return DocumentMetrics(self, kind, path)
+
+    def finish(self, metrics):
+        record = metrics.to_dict()
+        kind, status = record["kind"], record["status"]
+        with self._lock:
+            self._documents[(kind, status)] = self._documents.get((kind, status), 0) + 1
+            if status in _UNLOGGED_STATUSES:
+                return
+            key = (kind, "total")
+            self._stage_seconds[key] = self._stage_seconds.get(key, 0.0) + record["seconds"]
+            for stage, seconds in record["stages"].items():
+                self._stage_seconds[(kind, stage)] = self._stage_seconds.get((kind, stage), 0.0) + seconds
+            for name, value in record["counters"].items():
+                self._counters[(kind, name)] = self._counters.get((kind, name), 0) + value
+            if self.jsonl_path:
+                try:
+                    with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                except OSError as e:
+                    logging.warning(f"Failed to write metrics: {e}")
+
+    def log_prompt_cache_stats(self):
+        """サーバーのプロンプトキャッシュから読み込まれたプロンプトトークンの割合をログに出力する"""
+        with self._lock:
+            cached = sum(v for (_, name), v in self._counters.items() if name == "prompt_cached_tokens")
+            reported = sum(v for (_, name), v in self._counters.items() if name == "prompt_tokens_cache_reported")
+        if reported:
+            logging.info(f"LLM prompt cache: {cached}/{reported} prompt tokens reused ({cached / reported:.1%}).")
+
+    def write_prometheus(self, job):
+        """実行全体の集計を <prometheus_dir>/<job>.prom に書き出す"""
+        if not self.prometheus_dir:
+            return
+        with self._write_lock:
+            self._write_prometheus(job)
+
+    def _write_prometheus(self, job):
+        with self._lock:
+            lines = [
+                "# HELP scansnap_last_run_documents Documents handled in the last run, by status.",
+                "# TYPE scansnap_last_run_documents gauge",
+            ]
+            for (kind, status), count in sorted(self._documents.items()):
+                lines.append(f'scansnap_last_run_documents{{job="{job}",kind="{kind}",status="{status}"}} {count}')
+            lines += [
+                "# HELP scansnap_last_run_stage_seconds Wall time spent per stage in the last run.",
+                "# TYPE scansnap_last_run_stage_seconds gauge",
+            ]
+            for (kind, stage), seconds in sorted(self._stage_seconds.items()):
+                lines.append(f'scansnap_last_run_stage_seconds{{job="{job}",kind="{kind}",stage="{stage}"}} {seconds:.4f}')
+            # 同じメトリクス名の行が連続するよう、名前順に並べる
+            previous = None
+            for (kind, name), value in sorted(self._counters.items(), key=lambda item: (item[0][1], item[0][0])):
+                if name != previous:
+                    lines += [
+                        f"# HELP scansnap_last_run_{name} Total {name} in the last run.",
+                        f"# TYPE scansnap_last_run_{name} gauge",
+                    ]
+                    previous = name
+                lines.append(f'scansnap_last_run_{name}{{job="{job}",kind="{kind}"}} {value}')
+            lines += [
+                "# HELP scansnap_last_run_duration_seconds Duration of the last run.",
+                "# TYPE scansnap_last_run_duration_seconds gauge",
+                f'scansnap_last_run_duration_seconds{{job="{job}"}} {time.time() - self._started_at:.3f}',
+                "# HELP scansnap_last_run_timestamp_seconds Time the last run snapshot was written.",
+                "# TYPE scansnap_last_run_timestamp_seconds gauge",
+                f'scansnap_last_run_timestamp_seconds{{job="{job}"}} {time.time():.0f}',
+            ]
+
+        # textfile collector が書き込み途中のファイルを読まないよう、一時ファイルから置き換える。
+        # 複数のスレッドから書き出す場合に一時ファイルを取り合わず、古い集計で上書きしないよう、
+        # 一時ファイル名をスレッドごとに分け、書き出しは1スレッドずつ行う
+        self.prometheus_dir.mkdir(parents=True, exist_ok=True)
+        out_path = self.prometheus_dir / f"{job}.prom"
+        tmp_path = out_path.with_name(f"{out_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp_path, out_path)
+        except OSError as e:
+            logging.warning(f"Failed to write Prometheus metrics: {e}")
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_metrics(config):
+    """設定に応じたプロセス共通の計測器を返す
+
+    common.metrics.enabled が無効（既定）の場合もファイルに書き出さない計測器を返すため、
+    呼び出し側で有効・無効を判定する必要はない。
+    """
+    global _recorder
+    with _recorder_lock:
+        if _recorder is None:
+            metrics_cfg = config.get('common', {}).get('metrics', {})
+            if metrics_cfg.get('enabled', False):
+                jsonl_path = resolve_project_path(metrics_cfg.get('jsonl_file') or 'data/metrics.jsonl')
+                prometheus_dir = metrics_cfg.get('prometheus_dir', 'data/metrics')
+                _recorder = MetricsRecorder(
+                    jsonl_path,
+                    resolve_project_path(prometheus_dir) if prometheus_dir else None,
+                )
+            else:
+                _recorder = MetricsRecorder()
+        return _recorder
+
+
+def write_metrics_snapshot(job):
+    """実行終了時に Prometheus 形式の集計を書き出す（プロンプトキャッシュの利用率もログに出力する）"""
+    if _recorder is not None:
+        _recorder.log_prompt_cache_stats()
+        _recorder.write_prometheus(job)
@@ -0,0 +1,118 @@
+import time
+from collections import Counter
+import fitz  # PyMuPDF
+from core.concurrency import fitz_lock
+from core.dedupe import dhash
+
+# 背景（最頻の輝度）との差がこれを超える画素をインクとみなす（裏写り・地色のむらを除くため大きめ）
+_INK_DELTA = 48
+# スキャナーの縁の影やパンチ穴を除くため、上下左右から切り落とす割合
+_EDGE_MARGIN = 0.04
+# 重複判定に使う差分ハッシュのサイズ（hash_size x hash_size ビット）
+_HASH_SIZE = 16
+# 後ろのページほど情報量の評価を下げる度合い（表紙・1ページ目付近に要点が集まりやすいため）
+_POSITION_DECAY = 0.05
+
+
+class PageProfile:
+    """1ページ分の判定結果（インクの割合、白紙か、見た目の差分ハッシュ）"""
+
+    __slots__ = ("index", "ink_ratio", "blank", "dhash")
+
+    def __init__(self, index, ink_ratio, blank, dhash):
+        self.index = index
+        self.ink_ratio = ink_ratio
+        self.blank = blank
+        self.dhash = dhash
+
+
+class PageAnalyzer:
+    """低解像度のグレースケール画像から、白紙のページと見た目がほぼ同じページを判定する
+
+    両面スキャンの裏面のような白紙のページや、同じページの重複をAIに送らないために使う。
+    1ページあたり幅 thumbnail_width ピクセル程度の画像しか作らないため、本番の画像化より十分に軽い。
+    """
+
+    def __init__(self, blank_ink_ratio=0.002, duplicate_distance=6, thumbnail_width=150):
+        self.blank_ink_ratio = blank_ink_ratio
+        self.duplicate_distance = duplicate_distance
+        self.thumbnail_width = thumbnail_width
+
+    def profile(self, page, index):
+        """fitz のページから PageProfile を作る（fitz_lock を保持して呼ぶ）"""
+        rect = page.rect
+        clip = fitz.Rect(rect.x0 + rect.width * _EDGE_MARGIN, rect.y0 + rect.height * _EDGE_MARGIN,
+                         rect.x1 - rect.width * _EDGE_MARGIN, rect.y1 - rect.height * _EDGE_MARGIN)
+        scale = self.thumbnail_width / max(1.0, rect.width)
+        pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), clip=clip, colorspace=fitz.csGRAY, alpha=False)
+        width, height, stride, samples = pix.width, pix.height, pix.stride, pix.samples
+        if width == 0 or height == 0:
+            return PageProfile(index, 0.0, True, 0)
+        if stride != width:
+            samples = b"".join(samples[y * stride:y * stride + width] for y in range(height))
+            stride = width
+
+        # 画素ごとの比較はせず、輝度の度数分布とバイト列の置換・計数（C実装）で済ませる
+        background = Counter(samples).most_common(1)[0][0]
+        table = bytes(1 if abs(v - background) > _INK_DELTA else 0 for v in range(256))
+        ink_ratio = samples.translate(table).count(1) / (width * height)
+        return PageProfile(index, ink_ratio, ink_ratio < self.blank_ink_ratio,
+                           dhash(samples, width, height, stride, _HASH_SIZE))
+
+    def is_duplicate(self, a, b):
+        """2ページの見た目がほぼ同じか"""
+        return (a.dhash ^ b.dhash).bit_count() <= self.duplicate_distance
+
+    def select_pages(self, profiles, max_pages):
+        """要約に送るページを最大 max_pages 枚選び、ページ順のリストで返す
+
+        白紙のページは除き、枠が足りない場合は直前までに選んだページと見た目がほぼ同じページも除く。
+        そのうえで最初と最後のページを必ず含め、残りの枠はインクの多いページ（前のページほど優先）で埋める。
+        すべて白紙の場合は1ページ目だけを返す。
+        """
+        candidates = [p for p in profiles if not p.blank]
+        if not candidates:
+            return [profiles[0].index] if profiles else []
+        if len(candidates) > max_pages:
+            distinct = []
+            for p in candidates:
+                if not any(self.is_duplicate(p, q) for q in distinct):
+                    distinct.append(p)
+            if len(distinct) < max_pages:
+                # 重複を除くと枠が余る場合は、除いたページをページ順に戻す
+                extra = [p for p in candidates if p not in distinct][:max_pages - len(distinct)]
+                distinct = sorted(distinct + extra, key=lambda p: p.index)
+            candidates = distinct
+        if len(candidates) <= max_pages:
+            return [p.index for p in candidates]
+
+        chosen = [candidates[0], candidates[-1]][:max_pages]
+        middle = candidates[1:-1]
+        middle.sort(key=lambda p: p.ink_ratio / (1 + _POSITION_DECAY * p.index), reverse=True)
+        chosen += middle[:max_pages - len(chosen)]
+        return sorted(p.index for p in chosen)
+
+
+def analyze_pages(analyzer, doc, indices, metrics=None):
+    """開いているドキュメントの指定ページを判定し、{ページ番号: PageProfile} を返す"""
+    started = time.perf_counter()
+    profiles = {}
+    with fitz_lock:
+        for i in indices:
+            profiles[i] = analyzer.profile(doc[i], i)
+    if metrics is not None:
+        metrics.add_time("page_analysis", time.perf_counter() - started)
+        metrics.add("pages_blank", sum(1 for p in profiles.values() if p.blank))
+    return profiles
+
+
+def get_page_analyzer(config):
+    """設定（common.page_analysis）に応じた PageAnalyzer を返す。無効化されている場合は None"""
+    analysis_cfg = config.get('common', {}).get('page_analysis', {})
+    if not analysis_cfg.get('enabled', False):
+        return None
+    return PageAnalyzer(
+        blank_ink_ratio=float(analysis_cfg.get('blank_ink_ratio', 0.002)),
+        duplicate_distance=int(analysis_cfg.get('duplicate_distance', 6)),
+        thumbnail_width=int(analysis_cfg.get('thumbnail_width', 150)),
+    )
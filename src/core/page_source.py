@@ -0,0 +1,222 @@
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+import fitz  # PyMuPDF
+from core.concurrency import fitz_lock
+from core.image_payload import ImagePayload
+from core.page_analysis import analyze_pages
+
+_DONE = object()
+
+
+def render_page(doc, index, name, zoom=2, shaper=None, metrics=None):
+    """開いているドキュメントの1ページを画像化する（PageSource と画像化プロセスで共用）"""
+    if shaper is not None:
+        # 画像ファイル（JPEG）は原寸より拡大しない。PDFは設定の上限に従う
+        with fitz_lock:
+            max_zoom = None if doc.is_pdf else min(shaper.max_zoom, shaper.native_zoom(doc[0]))
+            return shaper.render_page(doc[index], name, metrics=metrics, max_zoom=max_zoom)
+
+    with fitz_lock:
+        started = time.perf_counter()
+        pix = doc[index].get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+        rendered = time.perf_counter()
+        payload = ImagePayload.from_pixmap(pix, name)
+        encoded = time.perf_counter()
+    if metrics is not None:
+        metrics.add_time("rasterize", rendered - started)
+        metrics.add_time("encode", encoded - rendered)
+        metrics.add("pages_rendered")
+    return payload
+
+
+class PageSource:
+    """PDFのページを必要になった時点でだけ画像化するページ供給クラス
+
+    全ページを事前に画像化するのではなく、呼び出し側が要求したページのみを
+    レンダリングする。iter_pages() はバックグラウンドで最大 lookahead ページ分だけ
+    先読みするジェネレータで、AI通信中に次のページの画像化を進められる。
+    """
+
+    def __init__(self, pdf_path, temp_dir=None, zoom=2, keep_files=False, metrics=None, shaper=None, pool=None):
+        self.pdf_path = pdf_path
+        # 画像化・エンコードの時間を記録する DocumentMetrics（省略可）
+        self.metrics = metrics
+        self.temp_dir = Path(temp_dir) if temp_dir else None
+        self.zoom = zoom
+        # PayloadShaper を渡すと、固定倍率のPNGの代わりにページごとに解像度・形式を決めて画像化する
+        self.shaper = shaper
+        # RenderPool を渡すと、iter_pages() は画像化を別プロセスに振り分けて複数ページを並行して進める
+        self.pool = pool
+        # 画像はメモリ上で受け渡す。keep_files が有効な場合のみ確認用に一時ディレクトリへ書き出す
+        self.keep_files = keep_files and self.temp_dir is not None
+        # 同名PDFを並行処理しても一時ファイルが衝突しないよう、インスタンスごとに接頭辞を分ける
+        self._prefix = f"{Path(pdf_path).stem}_{uuid.uuid4().hex[:8]}"
+        # 白紙・重複の判定結果（要約と全文OCRで共用する）
+        self._profiles = {}
+        with fitz_lock:
+            self.doc = fitz.open(pdf_path)
+            self.page_count = len(self.doc)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        """ドキュメントを閉じる"""
+        if self.doc is not None:
+            with fitz_lock:
+                self.doc.close()
+            self.doc = None
+
+    def render(self, index):
+        """指定ページ（0始まり）をメモリ上でPNGにエンコードして返す"""
+        payload = render_page(self.doc, index, f"{self._prefix}_page_{index}", self.zoom, self.shaper, self.metrics)
+        if self.keep_files:
+            payload.save(self.temp_dir)
+        return payload
+
+    def text(self, index):
+        """指定ページ（0始まり）に埋め込まれたテキストレイヤーを (テキスト, 被覆率) で返す
+
+        テキストがない場合は空文字列を返す。被覆率は、テキストのブロックの外接矩形の面積の合計が
+        ページの面積に占める割合（0〜1）で、見出しだけに文字がある画像主体のページでは小さくなる。
+        """
+        with fitz_lock:
+            started = time.perf_counter()
+            page = self.doc[index]
+            text = page.get_text("text")
+            rect = page.rect
+            covered = 0.0
+            # ブロックの種類（7番目の要素）が 0 のものがテキスト、1 は画像
+            for x0, y0, x1, y1, _, _, block_type in page.get_text("blocks"):
+                if block_type == 0:
+                    covered += fitz.Rect(x0, y0, x1, y1).intersect(rect).get_area()
+            area = rect.get_area()
+        if self.metrics is not None:
+            self.metrics.add_time("text_layer", time.perf_counter() - started)
+        return text, min(1.0, covered / area) if area else 0.0
+
+    def profiles(self, analyzer, indices=None):
+        """指定ページの判定結果を {ページ番号: PageProfile} で返す（判定済みのページは判定し直さない）"""
+        if indices is None:
+            indices = range(self.page_count)
+        missing = [i for i in indices if i not in self._profiles]
+        if missing:
+            self._profiles.update(analyze_pages(analyzer, self.doc, missing, self.metrics))
+        return {i: self._profiles[i] for i in indices}
+
+    def iter_pages(self, indices=None, lookahead=2, rendered=None):
+        """指定ページを順に (ページ番号, ImagePayload) として返すジェネレータ
+
+        lookahead が 1 以上の場合は別スレッドで先読みするが、未消費のページは
+        最大 lookahead 枚までに抑えられる。途中で列挙をやめた場合、残りのページは
+        レンダリングされない。
+        rendered に {ページ番号: ImagePayload} を渡すと、そのページは画像化せずにそのまま返す。
+        """
+        if indices is None:
+            indices = range(self.page_count)
+        indices = list(indices)
+
+        if rendered:
+            remaining = self.iter_pages([i for i in indices if i not in rendered], lookahead)
+            try:
+                for index in indices:
+                    if index in rendered:
+                        yield index, rendered[index]
+                    else:
+                        yield next(remaining)
+            finally:
+                remaining.close()
+            return
+
+        if self.pool is not None:
+            yield from self._iter_pool(indices)
+            return
+
+        if lookahead <= 0:
+            for index in indices:
+                yield index, self.render(index)
+            return
+
+        pages = queue.Queue(maxsize=lookahead)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            for index in indices:
+                if stop.is_set():
+                    return
+                try:
+                    item = (index, self.render(index), None)
+                except Exception as e:
+                    put((index, None, e))
+                    return
+                if not put(item):
+                    return
+            put(_DONE)
+
+        producer = threading.Thread(target=produce, name=f"render-{self._prefix}", daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = pages.get()
+                if item is _DONE:
+                    break
+                index, payload, error = item
+                if error is not None:
+                    raise error
+                yield index, payload
+        finally:
+            stop.set()
+            producer.join()
+
+    def _iter_pool(self, indices):
+        """画像化プロセスのプールに先行して依頼し、ページ順に受け取る
+
+        依頼できるページ数はプール全体の max_pending_pages で制限される。
+        受け取り待ちのページがある間は空き枠の分だけ依頼し、空きを待つのは
+        手元に何もない場合だけにする（書類どうしが枠を取り合って止まらないようにするため）。
+        """
+        path = str(Path(self.pdf_path).resolve())
+        window = deque()
+        remaining = iter(indices)
+        next_index = next(remaining, None)
+        try:
+            while next_index is not None or window:
+                while next_index is not None and self.pool.try_reserve(block=not window):
+                    name = f"{self._prefix}_page_{next_index}"
+                    window.append((next_index, self.pool.submit(path, next_index, name, self.zoom, self.shaper)))
+                    next_index = next(remaining, None)
+                index, future = window.popleft()
+                try:
+                    data, mime, stages, counters = future.result()
+                finally:
+                    self.pool.release()
+                if self.metrics is not None:
+                    for stage, seconds in stages.items():
+                        self.metrics.add_time(stage, seconds)
+                    for counter, value in counters.items():
+                        self.metrics.add(counter, value)
+                payload = ImagePayload(data, mime, f"{self._prefix}_page_{index}")
+                if self.keep_files:
+                    payload.save(self.temp_dir)
+                yield index, payload
+        finally:
+            # 途中で列挙をやめた場合、未着手のページは画像化しない
+            for _, future in window:
+                future.cancel()
+                self.pool.release()
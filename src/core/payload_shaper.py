@@ -0,0 +1,179 @@
+import math
+import os
+import time
+from pathlib import Path
+import fitz  # PyMuPDF
+from core.concurrency import fitz_lock
+from core.image_payload import ImagePayload
+
+# 色・余白の判定に使う縮小画像の幅（ピクセル）
+_THUMB_WIDTH = 96
+# R・G・B の差がこれを超える画素を有彩色とみなす
+_COLOR_DELTA = 32
+# 有彩色の画素がこの割合以下のページはモノクロとみなす
+_COLOR_RATIO = 0.005
+# 背景（四辺の画素の中央値）との輝度差がこれを超える画素を内容とみなす
+_MARGIN_DELTA = 40
+# 余白を除いても面積がこの割合以上残る場合は切り抜かない
+_MIN_CROP_GAIN = 0.95
+# 送信サイズの上限を超えた場合の縮小率と試行回数
+_SHRINK_FACTOR = 0.75
+_MAX_SHRINK_STEPS = 4
+
+
+class PayloadShaper:
+    """AIに送信する画像の解像度・色・余白・形式を、画素数と送信サイズの上限に合わせて決める
+
+    ページごとに用紙サイズから画像化の倍率を決め（max_pixels 以内、max_zoom 以下）、
+    モノクロのページはグレースケールで、スキャナーの余白は切り抜いて画像化する。
+    エンコード後のサイズが max_bytes を超える場合は、JPEGの画質を下げ、それでも
+    超える場合は解像度を下げて収まるまでやり直す。
+    """
+
+    def __init__(self, max_pixels=1_500_000, max_zoom=2.0, max_bytes=800 * 1024, grayscale=True,
+                 crop_margins=True, image_format="auto", jpeg_quality=85):
+        self.max_pixels = max_pixels
+        self.max_zoom = max_zoom
+        self.max_bytes = max_bytes
+        self.grayscale = grayscale
+        self.crop_margins = crop_margins
+        self.image_format = image_format
+        self.jpeg_quality = jpeg_quality
+
+    def render_page(self, page, name, metrics=None, max_zoom=None, analysis=None):
+        """fitz のページを送信用に画像化・エンコードした ImagePayload を返す
+
+        max_zoom を渡すと、設定値の代わりにその倍率を上限にする（画像ファイルを拡大しないために使用）。
+        analysis に判定済みの (モノクロか, 余白を除いた範囲) を渡すと、判定をやり直さない。
+        """
+        started = time.perf_counter()
+        with fitz_lock:
+            monochrome, clip = analysis if analysis is not None else self._analyze(page)
+            area = clip if clip is not None else page.rect
+            zoom = math.sqrt(self.max_pixels / max(1.0, area.width * area.height))
+            zoom = min(zoom, self.max_zoom if max_zoom is None else max_zoom)
+            colorspace = fitz.csGRAY if monochrome else fitz.csRGB
+
+            encode = 0.0
+            for _ in range(_MAX_SHRINK_STEPS + 1):
+                pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, colorspace=colorspace, alpha=False)
+                rendered = time.perf_counter()
+                data, mime = self._encode(pix, monochrome)
+                encode += time.perf_counter() - rendered
+                if len(data) <= self.max_bytes:
+                    break
+                zoom *= _SHRINK_FACTOR
+
+        if metrics is not None:
+            # 色・余白の判定も画像化の時間に含める
+            metrics.add_time("rasterize", time.perf_counter() - started - encode)
+            metrics.add_time("encode", encode)
+            metrics.add("pages_rendered")
+            if monochrome:
+                metrics.add("pages_grayscale")
+            if clip is not None:
+                metrics.add("pages_cropped")
+        return ImagePayload(data, mime, name)
+
+    def shape_file(self, path):
+        """画像ファイルを送信用に整える
+
+        画素数・サイズが上限以内で切り抜く余白もなければ、再エンコードせず原本のバイト列を使う。
+        """
+        path = Path(path)
+        with fitz_lock:
+            doc = fitz.open(path)
+            try:
+                page = doc[0]
+                native_zoom = self.native_zoom(page)
+                width = page.rect.width * native_zoom
+                height = page.rect.height * native_zoom
+                analysis = self._analyze(page)
+                if analysis[1] is None and width * height <= self.max_pixels and \
+                        os.path.getsize(path) <= self.max_bytes:
+                    return ImagePayload.from_file(path)
+                return self.render_page(page, path.stem, max_zoom=min(self.max_zoom, native_zoom), analysis=analysis)
+            finally:
+                doc.close()
+
+    def native_zoom(self, page):
+        """画像ファイルのページを原寸の画素数で画像化する倍率"""
+        images = page.get_images(full=True)
+        if images and page.rect.width > 0:
+            return images[0][2] / page.rect.width
+        return 1.0
+
+    def _analyze(self, page):
+        """縮小画像から (モノクロか, 余白を除いた範囲) を判定する。切り抜かない場合の範囲は None"""
+        if not self.grayscale and not self.crop_margins:
+            return False, None
+        rect = page.rect
+        scale = _THUMB_WIDTH / rect.width
+        pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), colorspace=fitz.csRGB, alpha=False)
+        width, height, stride, samples = pix.width, pix.height, pix.stride, pix.samples
+
+        colored = 0
+        luminance = []
+        for y in range(height):
+            row = samples[y * stride:y * stride + width * 3]
+            lum_row = []
+            for x in range(0, width * 3, 3):
+                r, g, b = row[x], row[x + 1], row[x + 2]
+                if max(r, g, b) - min(r, g, b) > _COLOR_DELTA:
+                    colored += 1
+                lum_row.append((r * 299 + g * 587 + b * 114) // 1000)
+            luminance.append(lum_row)
+        monochrome = self.grayscale and colored <= width * height * _COLOR_RATIO
+
+        clip = None
+        # 回転したページは座標の扱いが異なるため切り抜かない
+        if self.crop_margins and page.rotation == 0 and width > 2 and height > 2:
+            clip = self._content_rect(luminance, width, height, rect, scale)
+        return monochrome, clip
+
+    def _content_rect(self, luminance, width, height, rect, scale):
+        """背景と異なる画素を含む範囲をページ座標で返す（余白がほとんどない・白紙の場合は None）"""
+        border = luminance[0] + luminance[-1] + [row[0] for row in luminance] + [row[-1] for row in luminance]
+        background = sorted(border)[len(border) // 2]
+        rows = [y for y in range(height) if any(abs(v - background) > _MARGIN_DELTA for v in luminance[y])]
+        if not rows:
+            return None
+        cols = [x for x in range(width) if any(abs(luminance[y][x] - background) > _MARGIN_DELTA for y in rows)]
+        # 縮小画像の1画素分の誤差を見込んで、内容の周囲に2画素分の余裕を残す
+        x0, x1 = max(0, cols[0] - 2), min(width, cols[-1] + 3)
+        y0, y1 = max(0, rows[0] - 2), min(height, rows[-1] + 3)
+        if (x1 - x0) * (y1 - y0) >= width * height * _MIN_CROP_GAIN:
+            return None
+        return fitz.Rect(rect.x0 + x0 / scale, rect.y0 + y0 / scale,
+                         rect.x0 + x1 / scale, rect.y0 + y1 / scale) & rect
+
+    def _encode(self, pix, monochrome):
+        """(バイト列, MIMEタイプ) を返す。auto ではモノクロはPNG、カラーはJPEGを基本とする"""
+        fmt = self.image_format
+        if fmt == "png" or (fmt == "auto" and monochrome):
+            data = pix.tobytes("png")
+            if fmt == "png" or len(data) <= self.max_bytes:
+                return data, "image/png"
+        # 上限を超える場合は画質を段階的に下げる
+        quality = self.jpeg_quality
+        data = pix.tobytes("jpeg", jpg_quality=quality)
+        while len(data) > self.max_bytes and quality > 50:
+            quality = max(50, quality - 15)
+            data = pix.tobytes("jpeg", jpg_quality=quality)
+        return data, "image/jpeg"
+
+
+def get_payload_shaper(config):
+    """設定（common.image_payload）に応じた PayloadShaper を返す。無効化されている場合は None"""
+    shaper_cfg = config.get('common', {}).get('image_payload', {})
+    if not shaper_cfg.get('enabled', False):
+        return None
+    return PayloadShaper(
+        max_pixels=int(shaper_cfg.get('max_pixels', 1_500_000)),
+        max_zoom=float(shaper_cfg.get('max_zoom', 2.0)),
+        max_bytes=int(shaper_cfg.get('max_payload_kb', 800) * 1024),
+        grayscale=shaper_cfg.get('grayscale', True),
+        crop_margins=shaper_cfg.get('crop_margins', True),
+        image_format=shaper_cfg.get('format', 'auto'),
+        jpeg_quality=int(shaper_cfg.get('jpeg_quality', 85)),
+    )
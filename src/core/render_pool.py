@@ -0,0 +1,106 @@
+import logging
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+# 画像化プロセスごとに開いたままにしておくドキュメントの数
+_WORKER_OPEN_DOCS = 2
+_worker_docs = OrderedDict()
+
+
+def _worker_document(path):
+    """画像化プロセス内で、ドキュメントを開く（同じファイルの連続したページでは開き直さない）"""
+    import fitz  # PyMuPDF
+
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    doc = _worker_docs.get(key)
+    if doc is None:
+        doc = fitz.open(path)
+        _worker_docs[key] = doc
+        while len(_worker_docs) > _WORKER_OPEN_DOCS:
+            _, old = _worker_docs.popitem(last=False)
+            old.close()
+    else:
+        _worker_docs.move_to_end(key)
+    return doc
+
+
+def _render_in_worker(path, index, name, zoom, shaper):
+    """画像化プロセスで1ページを画像化し、(バイト列, MIMEタイプ, 工程別の秒数, 計数) を返す"""
+    from core.metrics import DocumentMetrics
+    from core.page_source import render_page
+
+    metrics = DocumentMetrics(None, "render", path)
+    payload = render_page(_worker_document(path), index, name, zoom, shaper, metrics)
+    return payload.data, payload.mime, metrics.stages, metrics.counters
+
+
+class RenderPool:
+    """ページの画像化を複数のプロセスで行うプール
+
+    fitz による画像化はCPU負荷が高く、スレッドでは1コアしか使えないため、
+    ページ単位で別プロセスに振り分ける。各プロセスはドキュメントを自分で開き、
+    エンコード済みのバイト列だけを返す。
+    max_pending_pages は、画像化を依頼してまだ受け取られていないページ数の上限
+    （プロセス全体、すべての書類の合計）で、メモリ使用量の上限になる。
+    """
+
+    def __init__(self, processes=None, max_pending_pages=None, max_tasks_per_child=None):
+        self.processes = max(1, int(processes or os.cpu_count() or 1))
+        self.max_pending_pages = max(1, int(max_pending_pages or self.processes * 2))
+        self._pending = threading.BoundedSemaphore(self.max_pending_pages)
+        # fork は他スレッドが保持中のロックを引き継いでしまうため、spawn で起動する
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            max_tasks_per_child=max_tasks_per_child or None,
+        )
+
+    def try_reserve(self, block):
+        """未受け取りのページ枠を1つ確保する（block が False なら空きがなければ False を返す）"""
+        return self._pending.acquire(blocking=block)
+
+    def release(self):
+        """確保したページ枠を返す（ページを受け取った、または依頼を取り消した時点で呼ぶ）"""
+        self._pending.release()
+
+    def submit(self, path, index, name, zoom=2, shaper=None):
+        """1ページの画像化を依頼し、Future を返す（事前に try_reserve で枠を確保しておくこと）"""
+        return self._executor.submit(_render_in_worker, str(path), index, name, zoom, shaper)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_render_pool(config):
+    """設定（common.render_pool）に応じたプロセス共通のプールを返す。無効化されている場合は None"""
+    global _pool
+    pool_cfg = config.get('common', {}).get('render_pool', {})
+    if not pool_cfg.get('enabled', False):
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = RenderPool(
+                processes=pool_cfg.get('processes'),
+                max_pending_pages=pool_cfg.get('max_pending_pages'),
+                max_tasks_per_child=pool_cfg.get('max_tasks_per_child', 200),
+            )
+            logging.info(f"Rendering pages in {_pool.processes} processes "
+                         f"(up to {_pool.max_pending_pages} pending pages).")
+        return _pool
+
+
+def shutdown_render_pool():
+    """実行終了時に画像化プロセスを終了する"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
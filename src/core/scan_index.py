@@ -0,0 +1,206 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from core.utils import resolve_project_path
+
+_MTIME_SETTLE_NS = 2_000_000_000
+
+
+def file_signature(stat_result):
+    """ファイルの変更検出に使う (サイズ, 更新日時ns, inode) の組"""
+    return stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino
+
+
+class ScanIndex:
+    """入力ディレクトリの走査結果を保存し、前回から増えた・変わったファイルだけを返す
+
+    ディレクトリの更新日時が前回と同じであれば一覧の取得（os.scandir）を省略し、
+    既知のサブディレクトリだけをたどる。何も変わっていなければディレクトリごとに
+    stat を1回行うだけで走査が終わる。
+
+    ファイルは処理に成功した時点で mark_done() により「処理済み」として記録される。
+    処理に失敗したファイルは、次回の走査でも再び対象として返される。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS dirs ("
+                " scope TEXT NOT NULL, path TEXT NOT NULL, parent TEXT, mtime_ns INTEGER NOT NULL,"
+                " PRIMARY KEY (scope, path))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                " scope TEXT NOT NULL, path TEXT NOT NULL, dir TEXT NOT NULL,"
+                " size INTEGER, mtime_ns INTEGER, inode INTEGER, done INTEGER NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (scope, path))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_files_dir ON files (scope, dir)")
+
+    def scan(self, scope, base_dir, extensions, verify_files=False):
+        """新規・変更・未処理のファイルを (フルパス, 相対ディレクトリ, シグネチャ) のリストで返す
+
+        verify_files が True の場合、一覧が変わっていないディレクトリでも既知のファイルを
+        stat して内容の変更（その場での上書き保存）を検出する。
+        """
+        base_dir = os.path.normpath(base_dir)
+        extensions = tuple(ext.lower() for ext in extensions)
+        with self._lock:
+            known_dirs = {
+                path: (parent, mtime_ns)
+                for path, parent, mtime_ns in self._conn.execute(
+                    "SELECT path, parent, mtime_ns FROM dirs WHERE scope = ?", (scope,))
+            }
+        children = {}
+        for path, (parent, _) in known_dirs.items():
+            children.setdefault(parent, []).append(path)
+
+        results = []
+        visited = set()
+        stack = [base_dir]
+        while stack:
+            dir_path = stack.pop()
+            try:
+                dir_mtime = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+            visited.add(dir_path)
+
+            known = known_dirs.get(dir_path)
+            if known and known[1] == dir_mtime:
+                # 一覧が変わっていないディレクトリは既知のサブディレクトリのみをたどる
+                stack.extend(children.get(dir_path, []))
+                results.extend(self._check_known_files(scope, base_dir, dir_path, verify_files))
+            else:
+                subdirs, found = self._list_dir(dir_path, extensions)
+                stack.extend(subdirs)
+                results.extend(self._update_dir(scope, base_dir, dir_path, dir_mtime, subdirs, found))
+
+        # 削除されたディレクトリの記録を消す
+        removed = [path for path in known_dirs if path not in visited and _is_under(path, base_dir)]
+        if removed:
+            with self._lock, self._conn:
+                self._conn.executemany("DELETE FROM dirs WHERE scope = ? AND path = ?", [(scope, p) for p in removed])
+                self._conn.executemany("DELETE FROM files WHERE scope = ? AND dir = ?", [(scope, p) for p in removed])
+        return results
+
+    def _list_dir(self, dir_path, extensions):
+        subdirs = []
+        found = {}
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(os.path.normpath(entry.path))
+                        elif entry.name.lower().endswith(extensions):
+                            found[entry.path] = file_signature(entry.stat())
+                    except OSError as e:
+                        logging.warning(f"Failed to stat {entry.path}: {e}")
+        except OSError as e:
+            logging.warning(f"Failed to list {dir_path}: {e}")
+        return subdirs, found
+
+    def _update_dir(self, scope, base_dir, dir_path, dir_mtime, subdirs, found):
+        """一覧を取得したディレクトリの記録を更新し、処理が必要なファイルを返す"""
+        results = []
+        relative_dir = _relative_dir(dir_path, base_dir)
+        with self._lock, self._conn:
+            known_files = {
+                path: (size, mtime_ns, inode, done)
+                for path, size, mtime_ns, inode, done in self._conn.execute(
+                    "SELECT path, size, mtime_ns, inode, done FROM files WHERE scope = ? AND dir = ?",
+                    (scope, dir_path))
+            }
+            for path, signature in found.items():
+                known = known_files.get(path)
+                if known is None or tuple(known[:3]) != signature:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO files (scope, path, dir, size, mtime_ns, inode, done) "
+                        "VALUES (?, ?, ?, ?, ?, ?, 0)",
+                        (scope, path, dir_path, *signature)
+                    )
+                    results.append((path, relative_dir, signature))
+                elif not known[3]:
+                    results.append((path, relative_dir, signature))
+            deleted = [path for path in known_files if path not in found]
+            self._conn.executemany("DELETE FROM files WHERE scope = ? AND path = ?", [(scope, p) for p in deleted])
+            parent = None if dir_path == base_dir else os.path.dirname(dir_path)
+            # 更新日時の分解能が粗いファイルシステムでは、一覧取得の直後に追加されたファイルを
+            # 見逃さないよう、更新直後のディレクトリは次回も一覧を取得させる
+            if time.time_ns() - dir_mtime < _MTIME_SETTLE_NS:
+                dir_mtime = -1
+            self._conn.execute(
+                "INSERT OR REPLACE INTO dirs (scope, path, parent, mtime_ns) VALUES (?, ?, ?, ?)",
+                (scope, dir_path, parent, dir_mtime)
+            )
+            for subdir in subdirs:
+                # 新しいサブディレクトリは未走査として登録し、直後の走査で一覧を取得させる
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO dirs (scope, path, parent, mtime_ns) VALUES (?, ?, ?, -1)",
+                    (scope, subdir, dir_path)
+                )
+        return results
+
+    def _check_known_files(self, scope, base_dir, dir_path, verify_files):
+        """一覧が変わっていないディレクトリ内で、未処理または変更されたファイルを返す"""
+        query = "SELECT path, size, mtime_ns, inode, done FROM files WHERE scope = ? AND dir = ?"
+        if not verify_files:
+            query += " AND done = 0"
+        with self._lock:
+            rows = self._conn.execute(query, (scope, dir_path)).fetchall()
+        results = []
+        relative_dir = _relative_dir(dir_path, base_dir)
+        for path, size, mtime_ns, inode, done in rows:
+            try:
+                signature = file_signature(os.stat(path))
+            except OSError:
+                continue
+            if not done or signature != (size, mtime_ns, inode):
+                results.append((path, relative_dir, signature))
+        return results
+
+    def mark_done(self, scope, path, signature=None):
+        """ファイルを処理済みとして記録する。signature を省略した場合は現在の状態を記録する
+
+        走査していないファイル（常駐中に追加されたファイルなど）は新しく登録する。
+        """
+        if signature is None:
+            try:
+                signature = file_signature(os.stat(path))
+            except OSError:
+                return
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO files (scope, path, dir, size, mtime_ns, inode, done) VALUES (?, ?, ?, ?, ?, ?, 1) "
+                "ON CONFLICT (scope, path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, "
+                "inode = excluded.inode, done = 1",
+                (scope, path, os.path.dirname(path), *signature)
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _relative_dir(dir_path, base_dir):
+    relative_dir = os.path.relpath(dir_path, base_dir)
+    return "" if relative_dir == "." else relative_dir
+
+
+def _is_under(path, base_dir):
+    return path == base_dir or path.startswith(base_dir.rstrip(os.sep) + os.sep)
+
+
+def open_scan_index(config):
+    """common.scan_index_file（既定: data/scan_index.sqlite3）の走査インデックスを開く"""
+    db_path = resolve_project_path(config.get('common', {}).get('scan_index_file') or 'data/scan_index.sqlite3')
+    return ScanIndex(db_path)
@@ -0,0 +1,47 @@
+import re
+
+# 日本語の書類として妥当とみなす文字の範囲
+_KANA = re.compile(r'[\u3041-\u3096\u30a1-\u30fa]')
+_KANJI = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff]')
+_VALID = re.compile(
+    r'[!-~'  # ASCII（空白以外）
+    r'\u00a1-\u00ff'  # Latin-1 の記号など
+    r'\u2010-\u2027\u2030-\u205e'  # 一般的な句読点・記号
+    r'\u2100-\u22ff\u2460-\u24ff\u2500-\u25ff'  # 文字様記号・数学記号・丸数字・罫線・図形
+    r'\u3000-\u303f'  # 和文の句読点
+    r'\u3040-\u30ff'  # ひらがな・カタカナ
+    r'\u3400-\u4dbf\u4e00-\u9fff'  # 漢字
+    r'\uff00-\uffef]'  # 全角英数・半角カナ
+)
+
+
+def text_quality(text):
+    """埋め込みテキストの品質を 0〜1 で評価する
+
+    空白以外の文字のうち、日本語の書類で通常使われる文字の割合を基本とする。
+    文字化け（置換文字・私用領域・制御文字など）が多いほど低くなる。
+    漢字が多いのにかながほとんど含まれない場合は、誤った文字コードの変換とみなして減点する。
+    """
+    chars = [c for c in text if not c.isspace()]
+    if not chars:
+        return 0.0
+    valid = sum(1 for c in chars if _VALID.match(c))
+    score = valid / len(chars)
+    kanji = sum(1 for c in chars if _KANJI.match(c))
+    kana = sum(1 for c in chars if _KANA.match(c))
+    if kanji >= 20 and kana < kanji * 0.1:
+        score *= 0.5
+    return score
+
+
+def usable_text(text, coverage, min_chars=20, min_score=0.9, min_coverage=0.05):
+    """テキストレイヤーをOCR結果として使えるかを (使えるか, スコア) で返す
+
+    空白以外の文字が min_chars 未満のページ（画像のみのページなど）や、テキストの被覆率
+    （テキストのブロックがページに占める面積の割合）が min_coverage 未満のページ
+    （見出しだけに文字があり、本文が画像のページなど）は使わない。
+    """
+    if sum(1 for c in text if not c.isspace()) < min_chars or coverage < min_coverage:
+        return False, 0.0
+    score = text_quality(text)
+    return score >= min_score, score
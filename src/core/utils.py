@@ -1,4 +1,5 @@
 import re
+from pathlib import Path
 
 def sanitize_filename(filename):
     """ファイル名に使用できない文字を置換し、適切なファイル名に調整する"""
@@ -16,6 +17,25 @@ def sanitize_filename(filename):
     sanitized = sanitized.strip('_').strip()
     return sanitized
 
+def read_front_matter(md_path, max_lines=50):
+    """Markdownファイル先頭のフロントマターだけを読み込んで返す（最大 max_lines 行）
+
+    フロントマターがないファイルでは空文字列を返す。本文は読み込まない。
+    """
+    with open(md_path, "r", encoding="utf-8") as f:
+        first_line = f.readline()
+        if first_line.strip() != "---":
+            return ""
+        lines = [first_line]
+        for _ in range(max_lines):
+            line = f.readline()
+            if not line:
+                break
+            lines.append(line)
+            if line.strip() == "---":
+                break
+        return "".join(lines)
+
 def convert_japanese_era_to_western(date_str):
     """和暦を西暦に変換する。変換できない場合は元の文字列を返す"""
     if not date_str or date_str == "不明":
@@ -88,3 +108,10 @@ def extract_yyyymmdd(date_str):
         return f"{year_match.group(1)}0000"
         
     return None
+
+# プロジェクトのルートディレクトリ（src/ の1つ上）
+PROJECT_ROOT = Path(__file__).parent.parent.parent
+
+def resolve_project_path(path_str):
+    """設定ファイル中の相対パスをプロジェクトルート基準の絶対パスに変換する"""
+    return PROJECT_ROOT / path_str
@@ -0,0 +1,81 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+
+class VaultNameIndex:
+    """出力先ディレクトリ（Vault）のファイル名を記憶し、重複しない出力パスを割り当てる索引
+
+    ディレクトリごとに最初の割り当て時に1回だけ一覧を取得し（ディレクトリがなければ作成する）、
+    以降はメモリ上の集合で判定するため、書類ごとの存在確認（stat）は行わない。
+    割り当てたファイル名はその場で使用中として登録するため、書き込み・コピーの前でも
+    並行して処理している他の書類に同じパスが割り当てられることはない。
+    Vault を他のプログラムが更新する場合に備え、一覧は refresh_seconds ごとに取得し直す。
+    Windows・SMB 共有を考慮し、ファイル名は大文字・小文字を区別せずに比較する。
+    """
+
+    def __init__(self, refresh_seconds=300):
+        self.refresh_seconds = refresh_seconds
+        # ディレクトリ -> (一覧を取得した時刻, 使用中のファイル名の集合)
+        self._dirs = {}
+        # 割り当て済みでまだディスク上にないかもしれないファイル名（一覧の取得し直しで消えないよう別に持つ）
+        self._reserved = {}
+        self._lock = threading.Lock()
+
+    def _names(self, directory):
+        """directory の使用中のファイル名の集合を返す（_lock を保持して呼ぶ）"""
+        key = os.path.normcase(os.path.abspath(directory))
+        loaded = self._dirs.get(key)
+        now = time.monotonic()
+        if loaded is not None and (not self.refresh_seconds or now - loaded[0] < self.refresh_seconds):
+            return loaded[1]
+        try:
+            with os.scandir(directory) as entries:
+                names = {entry.name.casefold() for entry in entries}
+        except FileNotFoundError:
+            os.makedirs(directory, exist_ok=True)
+            names = set()
+        reserved = self._reserved.setdefault(key, set())
+        # ディスク上に現れた（書き込みが済んだ）ファイル名は予約から外す
+        reserved -= names
+        names |= reserved
+        self._dirs[key] = (now, names)
+        return names
+
+    def allocate(self, directory, file_name):
+        """directory 内で未使用のパスを割り当てて返す
+
+        同名のファイルがある場合は、従来どおり名前の後ろに日時（秒まで）を付け、
+        それでも重複する場合はさらに連番を付ける。
+        """
+        stem, suffix = os.path.splitext(file_name)
+        with self._lock:
+            names = self._names(directory)
+            candidate = file_name
+            if candidate.casefold() in names:
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                candidate = f"{stem}_{timestamp}{suffix}"
+                n = 2
+                while candidate.casefold() in names:
+                    candidate = f"{stem}_{timestamp}_{n}{suffix}"
+                    n += 1
+            names.add(candidate.casefold())
+            self._reserved[os.path.normcase(os.path.abspath(directory))].add(candidate.casefold())
+        return os.path.join(directory, candidate)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_vault_index(config):
+    """設定（summarizer.output_index）に応じたプロセス共通の索引を返す。無効化されている場合は None"""
+    global _index
+    index_cfg = config.get('summarizer', {}).get('output_index', {})
+    if not index_cfg.get('enabled', True):
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = VaultNameIndex(refresh_seconds=index_cfg.get('refresh_seconds', 300))
+        return _index
@@ -0,0 +1,194 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+# inotify のイベント種別（linux/inotify.h）
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """inotify でディレクトリツリーを監視し、変更のあった対象ファイルのパスを返す（Linux専用）"""
+
+    def __init__(self, directories, extensions):
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watches = {}
+        self.directories = [os.path.normpath(d) for d in directories]
+        for directory in self.directories:
+            self._add_tree(directory)
+
+    def _add_tree(self, directory):
+        """ディレクトリ以下を再帰的に監視対象に加え、既に存在する対象ファイルを返す"""
+        existing = []
+        for root, dirs, files in os.walk(directory):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(root), _WATCH_MASK)
+            if wd < 0:
+                logging.warning(f"Failed to watch {root}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self._watches[wd] = root
+            existing.extend(os.path.join(root, f) for f in files if f.lower().endswith(self.extensions))
+        return existing
+
+    def poll(self, timeout):
+        """最大 timeout 秒待ち、変更のあった対象ファイルのパスを返す"""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        changed = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_len = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_len].rstrip(b"\0"))
+            offset += name_len
+
+            if mask & IN_Q_OVERFLOW:
+                # イベントが溢れた場合は監視中のツリーをすべて確認し直す
+                logging.warning("inotify event queue overflowed. Rescanning watched directories.")
+                for directory in self.directories:
+                    changed.extend(self._list_files(directory))
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            parent = self._watches.get(wd)
+            if parent is None or not name:
+                continue
+            path = os.path.join(parent, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # 新しいサブディレクトリは監視を追加し、監視開始前に置かれたファイルも拾う
+                    changed.extend(self._add_tree(path))
+            elif name.lower().endswith(self.extensions):
+                changed.append(path)
+        return changed
+
+    def _list_files(self, directory):
+        return [
+            os.path.join(root, f)
+            for root, _, files in os.walk(directory)
+            for f in files if f.lower().endswith(self.extensions)
+        ]
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    """inotify が使えない環境向けに、一定間隔でツリーを走査して変更を検出する"""
+
+    def __init__(self, directories, extensions, interval=5.0):
+        self.directories = [os.path.normpath(d) for d in directories]
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.interval = interval
+        self._snapshot = self._take_snapshot()
+        self._next_scan = time.monotonic() + interval
+
+    def _take_snapshot(self):
+        snapshot = {}
+        for directory in self.directories:
+            for root, _, files in os.walk(directory):
+                for f in files:
+                    if f.lower().endswith(self.extensions):
+                        path = os.path.join(root, f)
+                        try:
+                            stat = os.stat(path)
+                        except OSError:
+                            continue
+                        snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def poll(self, timeout):
+        wait = self._next_scan - time.monotonic()
+        if wait > 0:
+            time.sleep(min(wait, timeout))
+            if time.monotonic() < self._next_scan:
+                return []
+        self._next_scan = time.monotonic() + self.interval
+        snapshot = self._take_snapshot()
+        changed = [path for path, sig in snapshot.items() if self._snapshot.get(path) != sig]
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+def create_watcher(directories, extensions, poll_interval=5.0):
+    """Linux では inotify、それ以外の環境ではポーリングでの監視を返す"""
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(directories, extensions)
+        except (OSError, AttributeError) as e:
+            logging.warning(f"inotify is not available ({e}). Falling back to polling.")
+    return PollingWatcher(directories, extensions, interval=poll_interval)
+
+
+class WriteSettler:
+    """書き込み中のファイルを除外するためのデバウンス処理
+
+    最後の変更から settle_seconds の間サイズと更新日時が変わらなかったファイルを
+    書き込み完了とみなす。
+    """
+
+    def __init__(self, settle_seconds=5.0):
+        self.settle_seconds = settle_seconds
+        self._pending = {}
+
+    def touch(self, path):
+        """変更を通知されたファイルを待機リストに入れる（待機時間はリセットされる）"""
+        self._pending[path] = (time.monotonic(), _signature(path))
+
+    def ready(self):
+        """書き込みが完了したとみなせるファイルを返し、待機リストから外す"""
+        now = time.monotonic()
+        done = []
+        for path, (last_change, signature) in list(self._pending.items()):
+            if now - last_change < self.settle_seconds:
+                continue
+            current = _signature(path)
+            if current is None:
+                # 一時ファイルのリネームなどで消えた場合
+                del self._pending[path]
+            elif current != signature or current[0] == 0:
+                self._pending[path] = (now, current)
+            else:
+                del self._pending[path]
+                done.append(path)
+        return done
+
+
+def _signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
@@ -1,12 +1,20 @@
 import os
 import json
 import logging
-import base64
 import re
 from datetime import datetime
 from pathlib import Path
-import fitz  # PyMuPDF
-from openai import OpenAI
+from core.llm_cache import log_llm_cache_stats
+from core.llm_router import get_llm_router, log_llm_router_stats
+from core.metrics import get_metrics, write_metrics_snapshot
+from core.page_source import PageSource
+from core.payload_shaper import get_payload_shaper
+from core.render_pool import get_render_pool, shutdown_render_pool
+from core.fulltext_ocr import FULLTEXT_HEADING, FulltextOCR
+from core.history_store import open_history_store
+from core.scan_index import open_scan_index
+from core.file_index import FileNameIndex
+from core.utils import read_front_matter
 
 # ロギング設定
 logging.basicConfig(level=logging.INFO,
@@ -25,91 +33,59 @@ def sanitize_filename(filename):
 class ObsidianOCREnhancer:
     def __init__(self, config):
         self.config = config
-        self.client = OpenAI(base_url=config['common']['lm_studio_base_url'], api_key="lm-studio")
+        # 要約処理と同じく、LLMサーバーへの接続はプロセス内で共有する
+        self.llm = get_llm_router(config)
+        # 画像はメモリ上で送信するため、一時ディレクトリは keep_temp_files が有効な場合のみ使用する
         self.temp_dir = Path(config['common'].get('temp_directory', 'temp_images'))
-        if not self.temp_dir.exists():
+        if config['common'].get('keep_temp_files', False) and not self.temp_dir.exists():
             self.temp_dir.mkdir(parents=True)
         
-        # 履歴ファイルのパス決定
-        history_cfg = config['common'].get('history_file')
-        script_dir = Path(__file__).parent.parent
-        if history_cfg:
-            self.history_path = script_dir / history_cfg
-        else:
-            self.history_path = script_dir / "data" / "history.json"
-
-        self.history = self.load_history()
-
-    def load_history(self):
-        """履歴ファイルを読み込む。古い形式（パス:パス）もサポートする"""
-        if self.history_path.exists():
-            try:
-                with open(self.history_path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    # 互換性チェック: 全ての値が辞書形式か、古い文字列形式か
-                    structured_data = {}
-                    for key, value in data.items():
-                        if isinstance(value, str):
-                            structured_data[key] = {"md_path": value, "ocr_completed": False}
-                        else:
-                            structured_data[key] = value
-                    return structured_data
-            except Exception as e:
-                logging.warning(f"Failed to load history: {e}")
-        return {}
-
-    def save_history(self):
-        try:
-            with open(self.history_path, "w", encoding="utf-8") as f:
-                json.dump(self.history, f, ensure_ascii=False, indent=4)
-        except Exception as e:
-            logging.error(f"Failed to save history: {e}")
-
-    def encode_image(self, image_path):
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
-
-    def pdf_to_images(self, pdf_path):
-        """PDFの全ページを一時的にPNG画像に変換する"""
-        images = []
+        # 要約処理と共有する履歴ストア
+        self.history = open_history_store(config)
+        self.metrics = get_metrics(config)
+        self.ocr = FulltextOCR(config, self.llm, self.history)
+        self.shaper = get_payload_shaper(config)
+        # ページの画像化を複数プロセスで行う（common.render_pool が無効なら None）
+        self.render_pool = get_render_pool(config)
+
+        # Wikiリンク形式の source を解決するための索引（実行ごとに1回だけ走査する）
+        summarizer_cfg = config.get('summarizer', {})
+        self.source_index = FileNameIndex([
+            summarizer_cfg.get('pdf_output', {}).get('destination_directory'),
+            summarizer_cfg.get('pdf', {}).get('destination_directory'),
+            summarizer_cfg.get('jpeg', {}).get('destination_directory'),
+        ])
+
+    def needs_ocr(self, md_path, completed_paths):
+        """フロントマターだけを読み、全文OCRの対象になりうるノートかを判定する
+
+        source のないノートと、履歴上OCR済みのノート（reprocess_ocr: true を除く）は対象外。
+        """
         try:
-            doc = fitz.open(pdf_path)
-            for i, page in enumerate(doc):
-                pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-                img_path = self.temp_dir / f"{Path(pdf_path).stem}_page_{i}.png"
-                pix.save(str(img_path))
-                images.append(img_path)
-            doc.close()
+            front_matter = read_front_matter(md_path)
         except Exception as e:
-            logging.error(f"Error converting PDF to images: {e}")
-        return images
-
-    def get_page_ocr(self, image_path, page_num):
-        """指定されたページの画像からOCRテキストを取得する"""
-        try:
-            prompt = self.config['ocr_enhancer']['fulltext_prompt'].format(page_number=page_num)
-            base64_image = self.encode_image(image_path)
-            
-            content = [
-                {"type": "text", "text": prompt},
-                {
-                    "type": "image_url",
-                    "image_url": {"url": f"data:image/png;base64,{base64_image}"}
-                }
-            ]
-
-            response = self.client.chat.completions.create(
-                model=self.config['common']['llm_model'],
-                messages=[{"role": "user", "content": content}],
-                temperature=0.2, # OCRの正確性を高めるため低めに設定
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            logging.error(f"Error during OCR for page {page_num}: {e}")
-            return f"### ページ {page_num}\n\n[[読み取り失敗: {e}]]"
+            logging.warning(f"Error reading frontmatter of {md_path}: {e}")
+            return False
+        if not re.search(r'^source:\s*"', front_matter, re.MULTILINE):
+            return False
+        if re.search(r'^reprocess_ocr:\s*true', front_matter, re.MULTILINE | re.IGNORECASE):
+            return True
+        return str(Path(md_path).resolve()).replace('\\', '/') not in completed_paths
 
     def enhance_markdown(self, md_path):
-        """Markdownファイルを読み込み、PDFからOCR結果を追記する"""
+        """Markdownファイルを読み込み、PDFからOCR結果を追記する
+
+        OCR済み（スキップを含む）なら True、失敗時は False、
+        フロントマターに source がない対象外のノートでは None を返す。
+        """
+        with self.metrics.document("ocr", md_path) as metrics:
+            result = self.enhance_file(md_path, metrics)
+            if metrics.status is None:
+                metrics.status = {True: "processed", False: "failed", None: "ignored"}[result]
+            return result
+
+    def enhance_file(self, md_path, metrics):
+        """enhance_markdown() の本体。metrics（DocumentMetrics）に工程ごとの時間を記録する"""
         try:
             if not os.path.exists(md_path):
                 logging.error(f"Markdown file not found: {md_path}")
@@ -126,16 +102,18 @@ class ObsidianOCREnhancer:
             pdf_key = None # 後で取得
             
             if not force_reprocess:
-                if "## 全文（OCR）" in content:
+                if FULLTEXT_HEADING in content:
                     logging.info(f"Fulltext section already exists in {md_path}. Skipping.")
+                    metrics.status = "skipped"
                     return True
 
             # フロントマターからソースPDFを取得
             # 従来の "パス" 形式と新しい "[[ファイル名]]" (Wiki Link) 形式の両方に対応
             source_match = re.search(r'^source:\s*"(.*?)"', content, re.MULTILINE)
             if not source_match:
-                logging.warning(f"Source PDF info not found in frontmatter of {md_path}")
-                return False
+                # 取り込み対象外のノート
+                logging.debug(f"Source PDF info not found in frontmatter of {md_path}")
+                return None
             
             raw_source = source_match.group(1)
             pdf_path = raw_source
@@ -144,23 +122,16 @@ class ObsidianOCREnhancer:
             wiki_match = re.match(r'^\[\[(.*?)\]\]$', raw_source)
             if wiki_match:
                 pdf_filename = wiki_match.group(1)
-                # 設定されたPDF出力ディレクトリ内から検索
-                pdf_base_dir = self.config.get('summarizer', {}).get('pdf_output', {}).get('destination_directory')
-                if not pdf_base_dir:
+                # 設定された出力ディレクトリ（PDF・JPEG）の索引から検索する
+                if not self.source_index.directories:
                     logging.warning("PDF destination directory not configured. Cannot resolve Wiki Link.")
                     return False
                 
-                # 効率化のため、まずは直下やサブディレクトリを再帰的に探す
-                found_path = None
-                for root, dirs, files in os.walk(pdf_base_dir):
-                    if pdf_filename in files:
-                        found_path = os.path.join(root, pdf_filename)
-                        break
-                
+                found_path = self.source_index.find(pdf_filename)
                 if found_path:
                     pdf_path = found_path
                 else:
-                    logging.warning(f"Could not find PDF file '{pdf_filename}' in {pdf_base_dir}")
+                    logging.warning(f"Could not find PDF file '{pdf_filename}' in {', '.join(self.source_index.directories)}")
                     return False
 
             pdf_key = str(Path(pdf_path).resolve()).replace('\\', '/')
@@ -170,68 +141,44 @@ class ObsidianOCREnhancer:
                 return False
 
             # 履歴によるスキップ判定（強制再処理でない場合）
-            if not force_reprocess and pdf_key in self.history:
-                if self.history[pdf_key].get("ocr_completed"):
+            if not force_reprocess:
+                entry = self.history.get(pdf_key)
+                if entry and entry.get("ocr_completed"):
                     logging.info(f"OCR already completed for {pdf_path} (from history). Skipping.")
+                    metrics.status = "skipped"
                     return True
 
             logging.info(f"Enhancing {md_path} with OCR from {pdf_path}")
             
-            image_paths = []
-            # 画像化
-            image_paths = self.pdf_to_images(pdf_path)
-            if not image_paths:
-                return False
-            # 各ページのOCR
-            fulltext_parts = []
-            max_pages = self.config['ocr_enhancer'].get('fulltext_max_pages', 50)
-            
-            for i, img_path in enumerate(image_paths):
-                if i >= max_pages:
-                    logging.info(f"Reached max pages limit ({max_pages}).")
-                    fulltext_parts.append(f"\n\n> (注意: 設定により最大{max_pages}ページまでをOCR対象としています。)")
-                    break
-                
-                logging.info(f"Processing page {i+1}/{len(image_paths)}...")
-                page_text = self.get_page_ocr(img_path, i+1)
-                fulltext_parts.append(page_text)
+            # 各ページのOCR（OCR対象のページのみを順に画像化する）
+            keep_temp_files = self.config['common'].get('keep_temp_files', False)
 
-            # セクション構築
-            header = (
-                "\n---\n\n"
-                "## 全文（OCR）\n\n"
-                "> このセクションはAIにより画像から全文OCRされた内容です。\n"
-                "> レイアウトの忠実再現ではなく、可読性と検索性を優先しています。\n\n"
-            )
-            fulltext_combined = header + "\n\n".join(fulltext_parts)
+            with PageSource(pdf_path, self.temp_dir, keep_files=keep_temp_files, metrics=metrics,
+                            shaper=self.shaper, pool=self.render_pool) as source:
+                if source.page_count == 0:
+                    return False
+                fulltext_combined = self.ocr.ocr_document(source, checkpoint_key=pdf_key, metrics=metrics)
 
             # ファイルに追記（既存のセクションがあれば置換、なければ末尾に追加）
-            if "## 全文（OCR）" in content:
+            if FULLTEXT_HEADING in content:
                 # 既存セクションを削除して新しい内容に差し替える
-                new_content = re.sub(r'\n---\n\n## 全文（OCR）.*', fulltext_combined, content, flags=re.DOTALL)
+                new_content = re.sub(r'\n---\n\n' + re.escape(FULLTEXT_HEADING) + r'.*',
+                                     lambda _: fulltext_combined, content, flags=re.DOTALL)
             else:
                 new_content = content + fulltext_combined
 
             # reprocess_ocr を false に書き戻す
             new_content = re.sub(r'^reprocess_ocr:\s*true', 'reprocess_ocr: false', new_content, flags=re.MULTILINE | re.IGNORECASE)
 
-            with open(md_path, "w", encoding="utf-8") as f:
+            with metrics.stage("write"), open(md_path, "w", encoding="utf-8") as f:
                 f.write(new_content)
 
             # 履歴の更新
-            self.history[pdf_key] = {
-                "md_path": str(Path(md_path).resolve()).replace('\\', '/'),
-                "ocr_completed": True
-            }
-            self.save_history()
-
-            # 一時ファイルの削除
-            for img_path in image_paths:
-                try:
-                    if img_path.exists():
-                        img_path.unlink()
-                except:
-                    pass
+            self.history.update(
+                pdf_key,
+                md_path=str(Path(md_path).resolve()).replace('\\', '/'),
+                ocr_completed=True
+            )
 
             logging.info(f"Successfully enhanced {md_path}")
             return True
@@ -254,23 +201,53 @@ def main():
         logging.info("Fulltext OCR is disabled in config.")
         return
 
-    enhancer = ObsidianOCREnhancer(config)
-
     # 出力ディレクトリ内のMarkdownファイルをスキャン
     output_dir = config['ocr_enhancer']['output_directory']
     if not os.path.exists(output_dir):
         logging.error(f"Output directory not found: {output_dir}")
         return
 
+    enhancer = ObsidianOCREnhancer(config)
+
     processed_count = 0
-    for root, dirs, files in os.walk(output_dir):
-        for file_name in files:
-            if file_name.lower().endswith('.md'):
-                full_path = os.path.join(root, file_name)
-                if enhancer.enhance_markdown(full_path):
-                    processed_count += 1
+    if config['ocr_enhancer'].get('incremental_scan'):
+        # 前回から追加・変更されたMarkdownのみを対象にする
+        # （reprocess_ocr の書き換えもファイルの変更として検出される）
+        scan_index = open_scan_index(config)
+        scope = f"md:{Path(output_dir).resolve()}"
+        candidates = scan_index.scan(scope, output_dir, ('.md',), verify_files=True)
+        if not candidates:
+            # 処理がなくても、終了時の集計の書き出しは行う
+            logging.info("No new or changed notes.")
+        else:
+            # 履歴上OCR済みのノートは、フロントマターだけを確認して本文を読まずにスキップする
+            # （対象のノートがない場合は履歴を読み込まない）
+            completed_paths = enhancer.history.completed_md_paths()
+        for full_path, _, _ in candidates:
+            result = None
+            if enhancer.needs_ocr(full_path, completed_paths):
+                result = enhancer.enhance_markdown(full_path)
+            if result:
+                processed_count += 1
+            if result is not False:
+                # OCR追記でファイルが書き換わるため、処理後の状態を記録する
+                scan_index.mark_done(scope, full_path)
+    else:
+        completed_paths = enhancer.history.completed_md_paths()
+        for root, dirs, files in os.walk(output_dir):
+            for file_name in files:
+                if file_name.lower().endswith('.md'):
+                    full_path = os.path.join(root, file_name)
+                    if not enhancer.needs_ocr(full_path, completed_paths):
+                        continue
+                    if enhancer.enhance_markdown(full_path):
+                        processed_count += 1
 
     logging.info(f"OCR enhancement complete. {processed_count} files updated.")
+    log_llm_cache_stats()
+    log_llm_router_stats()
+    write_metrics_snapshot("obsidian_ocr_enhancer")
+    shutdown_render_pool()
 
 if __name__ == "__main__":
     main()
@@ -1,59 +1,85 @@
 import os
 import json
 import logging
-import base64
 import re
 import shutil
+import threading
 from datetime import datetime
 from pathlib import Path
-from openai import OpenAI
 from core.utils import sanitize_filename, extract_yyyymmdd
+from core.llm import chat_completion
+from core.llm_router import get_llm_router
+from core.image_payload import ImagePayload, image_content
+from core.llm_cache import get_llm_cache
+from core.history_store import open_history_store
+from core.dedupe import content_hash, perceptual_hash, hamming_distance
+from core.metrics import get_metrics
+from core.fulltext_ocr import FulltextOCR
+from core.page_analysis import get_page_analyzer
+from core.payload_shaper import get_payload_shaper
+from core.render_pool import get_render_pool
+from core.vault_index import get_vault_index
 
 class BaseProcessor:
+    # 並行処理時に出力先の決定が競合しないよう、全プロセッサで共有するロック
+    _output_lock = threading.Lock()
+    # 実行中に割り当てた出力パス（コピーはロックの外で行うため、ファイルができる前の重複も防ぐ）
+    _allocated_paths = set()
+    # 計測結果に記録する書類の種別
+    kind = "file"
+
     def __init__(self, config, format_config):
         self.config = config
         self.format_config = format_config
-        self.client = OpenAI(base_url=config['common']['lm_studio_base_url'], api_key="lm-studio")
+        # LLMサーバーへの接続はプロセス内で共有し、複数台の場合は負荷に応じて振り分ける
+        self.llm = get_llm_router(config)
+        # 画像はメモリ上で送信するため、一時ディレクトリは keep_temp_files が有効な場合のみ使用する
         self.temp_dir = Path(config['common'].get('temp_directory', 'temp_images'))
-        if not self.temp_dir.exists():
+        if config['common'].get('keep_temp_files', False) and not self.temp_dir.exists():
             self.temp_dir.mkdir(parents=True)
         
-        # 履歴ファイルのパス決定
-        history_cfg = config['common'].get('history_file')
-        script_dir = Path(__file__).parent.parent.parent
-        if history_cfg:
-            self.history_path = script_dir / history_cfg
-        else:
-            self.history_path = script_dir / "data" / "history.json"
-            
-        # 履歴は共有されるため、読み込みは呼び出し側か個別で行う必要があるが、
-        # ここではインスタンスごとに読み込む（本当はシングルトンか共有管理が良い）
-        self.history = self.load_history()
-
-    def load_history(self):
-        if self.history_path.exists():
-            try:
-                with open(self.history_path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    structured_data = {}
-                    for key, value in data.items():
-                        if isinstance(value, str):
-                            structured_data[key] = {"md_path": value, "ocr_completed": False}
-                        else:
-                            structured_data[key] = value
-                    return structured_data
-            except Exception as e:
-                logging.warning(f"Failed to load history: {e}")
-        return {}
-
-    def save_history(self):
-        try:
-            # 最新の状態をファイルから読み直してマージするのが安全だが、
-            # 現状のロジックを踏襲
-            with open(self.history_path, "w", encoding="utf-8") as f:
-                json.dump(self.history, f, ensure_ascii=False, indent=4)
-        except Exception as e:
-            logging.error(f"Failed to save history: {e}")
+        # 履歴ストアはプロセス内で共有され、エントリ単位で保存される
+        self.history = open_history_store(config)
+        self.metrics = get_metrics(config)
+        # 送信する画像の解像度・形式を整える（common.image_payload が無効なら None）
+        self.shaper = get_payload_shaper(config)
+        # ページの画像化を複数プロセスで行う（common.render_pool が無効なら None）
+        self.render_pool = get_render_pool(config)
+        # 白紙・重複ページの判定（common.page_analysis が無効なら None）
+        self.page_analyzer = get_page_analyzer(config)
+
+        # 出力先のファイル名の索引（summarizer.output_index が無効なら None）
+        self.vault_index = get_vault_index(config)
+        # 要約プロンプトの固定部分（書類によらない指示と分類ルール）は一度だけ組み立てる
+        self.summary_prompt = self._compile_summary_prompt()
+
+        # 単一パス取り込み: 要約と同じ実行内で全文OCRも行う（OCRの設定は ocr_enhancer を使用）
+        self.fulltext_ocr = None
+        if config.get('summarizer', {}).get('control', {}).get('single_pass_ocr') and \
+                config.get('ocr_enhancer', {}).get('fulltext_enabled', True):
+            self.fulltext_ocr = FulltextOCR(config, self.llm, self.history)
+
+    def _compile_summary_prompt(self):
+        """要約プロンプトの固定部分（分類ルールと summarizer.ai_analysis.prompt）を組み立てる"""
+        ai_analysis_config = self.config.get('summarizer', {}).get('ai_analysis', {})
+        base_prompt = ai_analysis_config.get('prompt') or ""
+        classifier_info = ""
+        if 'classification_rules' in ai_analysis_config:
+            rules = ai_analysis_config['classification_rules']
+            rules_text = "\n".join([f"- {r['name']}: {r.get('description', '')}" for r in rules])
+            classifier_info = (
+                f"\n\n### 分類ルールと判定基準\n"
+                f"以下のカテゴリ名から、書類の内容に最も合致するものを1つだけ選択してください。\n"
+                f"選択肢:\n{rules_text}\n"
+            )
+        return f"{classifier_info}\n\n{base_prompt}"
+
+    def build_prompt(self, *notes):
+        """要約用のプロンプトを返す。書類ごとの注記（ページの抜粋など）は固定部分の後ろに付ける
+
+        先頭が常に同じ文字列になるため、LLMサーバーのプロンプトキャッシュが書類をまたいで再利用される。
+        """
+        return self.summary_prompt + "".join(notes)
 
     def should_reprocess(self, md_path):
         if not os.path.exists(md_path):
@@ -73,34 +99,123 @@ class BaseProcessor:
             logging.warning(f"Error checking reprocess flag in {md_path}: {e}")
         return False
 
-    def encode_image(self, image_path):
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+    def compute_fingerprint(self, file_path):
+        """重複検出用の指紋 (内容ハッシュ, 知覚ハッシュ, ページ数) を計算する。無効時は None"""
+        dedupe_cfg = self.config.get('summarizer', {}).get('dedupe', {})
+        if not dedupe_cfg.get('enabled', True):
+            return None
+        try:
+            file_hash = content_hash(file_path)
+            phash, page_count = None, None
+            # 知覚ハッシュは同じ書式の別書類（毎月の明細など）も近い値になるため、既定では無効
+            if dedupe_cfg.get('perceptual', False):
+                phash, page_count = perceptual_hash(file_path)
+            return file_hash, phash, page_count
+        except Exception as e:
+            logging.warning(f"Failed to fingerprint {file_path}: {e}")
+            return None
+
+    def find_duplicate(self, file_key, fingerprint):
+        """処理済みの同一書類を探し、(キー, 履歴エントリ, 判定理由) を返す"""
+        file_hash, phash, page_count = fingerprint
+
+        def usable(key):
+            if key == file_key:
+                return None
+            entry = self.history.get(key)
+            # 既存のMarkdownが残っている場合のみ重複として扱う
+            if entry and entry.get("md_path") and os.path.exists(entry["md_path"]):
+                return entry
+            return None
 
-    def get_ai_summary(self, image_paths, custom_prompt=None):
+        for key in self.history.keys_by_content_hash(file_hash):
+            entry = usable(key)
+            if entry:
+                return key, entry, "identical content"
+
+        if phash:
+            max_distance = self.config.get('summarizer', {}).get('dedupe', {}).get('phash_max_distance', 6)
+            best = None
+            for key, _, other_phash, other_pages in self.history.fingerprints():
+                # ページ数が異なる書類は、1ページ目が似ていても別書類とみなす
+                if not other_phash or other_pages != page_count or len(other_phash) != len(phash):
+                    continue
+                distance = hamming_distance(phash, other_phash)
+                if distance <= max_distance and (best is None or distance < best[0]):
+                    best = (distance, key)
+            if best:
+                entry = usable(best[1])
+                if entry:
+                    return best[1], entry, f"perceptual match (distance {best[0]})"
+        return None
+
+    def link_duplicate(self, file_key, file_path, fingerprint):
+        """重複であれば既存のMarkdownに紐付けて True を返す（AIには問い合わせない）"""
+        if fingerprint is None:
+            return False
+        duplicate = self.find_duplicate(file_key, fingerprint)
+        if not duplicate:
+            return False
+        dup_key, dup_entry, reason = duplicate
+        self.history.put(file_key, {
+            "md_path": dup_entry["md_path"],
+            "ocr_completed": dup_entry.get("ocr_completed", False),
+            "duplicate_of": dup_key
+        })
+        self.history.record_fingerprint(file_key, *fingerprint)
+        logging.info(f"Duplicate of {dup_key} ({reason}): {file_path} linked to {dup_entry['md_path']}")
+        return True
+
+    def get_ai_summary(self, images, custom_prompt=None, metrics=None, image_labels=None, expect_json=True):
+        """画像（ImagePayload またはファイルパス）を送信し、AIの応答テキストを返す
+
+        image_labels を渡すと、各画像の直前にそのラベルをテキストとして挿入する（複数書類をまとめる場合に使用）。
+        expect_json は応答の形式で、JSONが閉じた時点で生成を打ち切る（"array" の場合はJSON配列）。
+        metrics（DocumentMetrics）を渡すと、送信バイト数・LLMの待ち時間・トークン数を記録する。
+        """
         try:
-            prompt = custom_prompt if custom_prompt else self.config.get('summarizer', {}).get('ai_analysis', {}).get('prompt')
+            prompt = custom_prompt if custom_prompt else self.build_prompt()
+            model = self.config['common']['llm_model']
+            temperature = 0.7
+            images = [image if isinstance(image, ImagePayload) else ImagePayload.from_file(image) for image in images]
+
+            # 同じ画像・プロンプト・モデルでの問い合わせ結果があれば再利用する
+            cache = get_llm_cache(self.config)
+            cache_key = None
+            if cache is not None:
+                cache_key = cache.make_key(model, temperature, prompt, images, image_labels)
+                cached = cache.get(cache_key)
+                if cached is not None:
+                    logging.info("Using cached AI response.")
+                    if metrics is not None:
+                        metrics.add("llm_cache_hits")
+                    return cached
+
             content = [{"type": "text", "text": prompt}]
-            for img_path in image_paths:
-                base64_image = self.encode_image(img_path)
-                content.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/png;base64,{base64_image}"
-                    }
-                })
-            response = self.client.chat.completions.create(
-                model=self.config['common']['llm_model'],
-                messages=[{"role": "user", "content": content}],
-                temperature=0.7,
-            )
-            return response.choices[0].message.content
+            for i, image in enumerate(images):
+                if image_labels:
+                    content.append({"type": "text", "text": image_labels[i]})
+                content.append(image_content(image))
+            # 応答はJSONを期待するため、JSONが閉じた時点で生成を打ち切る
+            result, stop_reason = chat_completion(self.llm, self.config, model, content, temperature,
+                                                  expect_json=expect_json, metrics=metrics)
+            if stop_reason == "repetition":
+                # 途中で打ち切った応答は欠けている可能性があるため、キャッシュせずに失敗とする
+                raise ValueError("repeated output detected; the response was cut off")
+            if metrics is not None:
+                metrics.add("payload_bytes", sum(len(image.data) for image in images))
+            if cache is not None and result:
+                cache.put(cache_key, result, model=model)
+            return result
         except Exception as e:
             logging.error(f"Error communicating with AI: {e}")
             return f"AI要約の取得に失敗しました: {e}"
 
     def get_output_paths(self, ai_data, source_path, relative_dir):
-        """出力先のディレクトリとファイル名を決定する"""
+        """出力先のディレクトリとファイル名を決定する
+
+        summarizer.output_index が有効な場合は、ファイルの存在確認を行わずに索引から割り当てる。
+        """
         ai_title = ai_data.get('title', '').strip()
         sanitized_title = sanitize_filename(ai_title)
         if not sanitized_title:
@@ -126,14 +241,11 @@ class BaseProcessor:
         # Markdown出力
         md_dest_base = self.config.get('summarizer', {}).get('markdown_output', {}).get('destination_directory')
         md_dir = os.path.join(md_dest_base, sub_dir)
-        if not os.path.exists(md_dir):
-            os.makedirs(md_dir)
-        
         md_name = f"{sanitized_title}.md"
-        md_path = os.path.join(md_dir, md_name)
-        if os.path.exists(md_path):
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            md_path = os.path.join(md_dir, f"{sanitized_title}_{timestamp}.md")
+        if self.vault_index is not None:
+            md_path = self.vault_index.allocate(md_dir, md_name)
+        else:
+            md_path = self._unique_path(md_dir, md_name)
 
         # リネーム（コピー）後ファイル名の決定
         new_name = Path(source_path).name
@@ -153,16 +265,34 @@ class BaseProcessor:
         if self.format_config.get('auto_copy'):
             copy_dest_base = self.format_config.get('destination_directory')
             copy_dir = os.path.join(copy_dest_base, sub_dir)
-            if not os.path.exists(copy_dir):
-                os.makedirs(copy_dir)
-            copy_path = os.path.join(copy_dir, new_name)
-            if os.path.exists(copy_path):
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                copy_path = os.path.join(copy_dir, f"{Path(new_name).stem}_{timestamp}{Path(new_name).suffix}")
+            if self.vault_index is not None:
+                copy_path = self.vault_index.allocate(copy_dir, new_name)
+            else:
+                copy_path = self._unique_path(copy_dir, new_name)
 
         return md_path, copy_path, category
 
-    def generate_markdown(self, output_path, ai_data, ai_response, category, source_file_name):
+    def _unique_path(self, directory, file_name):
+        """directory 内で未使用のパスを返す（_output_lock を保持して呼ぶ）
+
+        同名のファイルがある場合は名前の後ろに日時（秒まで）を付け、それでも重複する場合は
+        さらに連番を付ける。この実行で割り当て済みのパスも使用中とみなす。
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        stem, suffix = os.path.splitext(file_name)
+        path = os.path.join(directory, file_name)
+        if os.path.exists(path) or path in self._allocated_paths:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            path = os.path.join(directory, f"{stem}_{timestamp}{suffix}")
+            n = 2
+            while os.path.exists(path) or path in self._allocated_paths:
+                path = os.path.join(directory, f"{stem}_{timestamp}_{n}{suffix}")
+                n += 1
+        self._allocated_paths.add(path)
+        return path
+
+    def generate_markdown(self, output_path, ai_data, ai_response, category, source_file_name, fulltext=None):
         # ファイル作成日時の取得
         try:
             # 原本から取得したいが、BaseProcessorでは source_path が分からない場合があるため
@@ -203,5 +333,18 @@ class BaseProcessor:
             # プレビューとして原本ファイルを埋め込み
             f.write(f"\n\n## プレビュー\n\n![[{source_file_name}]]")
 
+            # 単一パス取り込みでは全文OCRのセクションも同時に書き込む
+            if fulltext:
+                f.write(fulltext)
+
     def process(self, file_path, relative_dir=""):
-        raise NotImplementedError("Subclasses must implement process()")
+        """1ファイルを処理する。成功（スキップ・重複を含む）時は True、失敗時は False を返す"""
+        with self.metrics.document(self.kind, file_path) as metrics:
+            result = self.process_file(file_path, relative_dir, metrics)
+            if metrics.status is None:
+                metrics.status = "processed" if result else "failed"
+            return result
+
+    def process_file(self, file_path, relative_dir, metrics):
+        """process() の本体。metrics（DocumentMetrics）に工程ごとの時間を記録する"""
+        raise NotImplementedError("Subclasses must implement process_file()")
@@ -2,64 +2,229 @@ import os
 import logging
 import re
 import json
+from contextlib import ExitStack
 from pathlib import Path
+from core.image_payload import ImagePayload
+from core.metrics import split_batch_metrics
+from core.page_source import PageSource
 from .base_processor import BaseProcessor
 
 class ImageProcessor(BaseProcessor):
-    def process(self, image_path, relative_dir=""):
+    kind = "jpeg"
+
+    def __init__(self, config, format_config):
+        super().__init__(config, format_config)
+        # バッチ処理: 小さな画像（レシート・名刺など）を複数枚まとめて1回の問い合わせで要約する
+        batch_cfg = format_config.get('batch', {})
+        self.batch_size = 1
+        if batch_cfg.get('enabled', False):
+            self.batch_size = max(1, int(batch_cfg.get('max_images', 8) or 1))
+        self.batch_max_bytes = int(batch_cfg.get('max_image_kb', 1024)) * 1024
+
+    def can_batch(self, image_path):
+        """バッチ処理の対象にできる（バッチ処理が有効で、ファイルが十分小さい）か"""
+        if self.batch_size < 2:
+            return False
+        try:
+            return os.path.getsize(image_path) <= self.batch_max_bytes
+        except OSError:
+            return False
+
+    def process_file(self, image_path, relative_dir, metrics):
         img_key = str(Path(image_path).resolve()).replace('\\', '/')
-        
-        if img_key in self.history:
-            entry = self.history[img_key]
+        handled, fingerprint = self._check_existing(img_key, image_path, metrics)
+        if handled:
+            return True
+
+        try:
+            with metrics.stage("read"):
+                image = self._read_image(image_path)
+        except Exception as e:
+            logging.error(f"Error processing {image_path}: {e}")
+            return False
+        return self._process_single(image_path, relative_dir, image, img_key, fingerprint, metrics)
+
+    def process_batch(self, items):
+        """複数の画像 [(パス, 相対ディレクトリ), ...] を1回の問い合わせで要約し、各ファイルの成否を返す
+
+        画像ごとの結果をJSON配列で受け取り、順番どおりに各ファイルへ割り当てる。
+        応答を解釈できない場合は、1枚ずつの問い合わせに切り替える。
+        """
+        results = [None] * len(items)
+        with ExitStack() as stack:
+            documents = [stack.enter_context(self.metrics.document(self.kind, path)) for path, _ in items]
+
+            pending = []
+            for i, (image_path, relative_dir) in enumerate(items):
+                metrics = documents[i]
+                img_key = str(Path(image_path).resolve()).replace('\\', '/')
+                handled, fingerprint = self._check_existing(img_key, image_path, metrics)
+                if handled:
+                    results[i] = True
+                    continue
+                try:
+                    with metrics.stage("read"):
+                        image = self._read_image(image_path)
+                except Exception as e:
+                    logging.error(f"Error processing {image_path}: {e}")
+                    results[i] = False
+                    continue
+                pending.append((i, image_path, relative_dir, image, img_key, fingerprint))
+
+            ai_items = None
+            if len(pending) > 1:
+                names = ", ".join(Path(image_path).name for _, image_path, *_ in pending)
+                logging.info(f"Processing {len(pending)} images in one request: {names}")
+                # 問い合わせの計測結果は、まとめた書類に均等に割り振る
+                batch_metrics = self.metrics.document(self.kind, "batch")
+                ai_response = self.get_ai_summary(
+                    [image for _, _, _, image, _, _ in pending],
+                    custom_prompt=self._build_prompt(batch_count=len(pending)),
+                    metrics=batch_metrics,
+                    image_labels=[f"画像 {n}:" for n in range(1, len(pending) + 1)],
+                    expect_json="array",
+                )
+                with batch_metrics.stage("parse"):
+                    ai_items = self._parse_batch_response(ai_response, len(pending))
+                split_batch_metrics(batch_metrics, [documents[i] for i, *_ in pending])
+                if ai_items is None:
+                    logging.warning(f"Could not parse the batched response for {len(pending)} images. "
+                                    f"Falling back to one request per image.")
+
+            for n, (i, image_path, relative_dir, image, img_key, fingerprint) in enumerate(pending):
+                metrics = documents[i]
+                if ai_items is None:
+                    results[i] = self._process_single(image_path, relative_dir, image, img_key, fingerprint, metrics)
+                    continue
+                logging.info(f"Processing Image: {image_path} (batched)")
+                ai_data = ai_items[n]
+                try:
+                    results[i] = self._finish(image_path, relative_dir, image, ai_data,
+                                              json.dumps(ai_data, ensure_ascii=False), img_key, fingerprint, metrics)
+                except Exception as e:
+                    logging.error(f"Error processing {image_path}: {e}")
+                    results[i] = False
+
+            for metrics, result in zip(documents, results):
+                if metrics.status is None:
+                    metrics.status = "processed" if result else "failed"
+        return results
+
+    def _check_existing(self, img_key, image_path, metrics):
+        """(処理を終えたか, 指紋) を返す。処理済み（スキップ）または重複の場合は処理を終えたとみなす
+
+        新規ファイルの指紋は、履歴への記録に再利用できるよう返す。
+        """
+        fingerprint = None
+        entry = self.history.get(img_key)
+        if entry:
             md_path_str = entry["md_path"]
             if not self.should_reprocess(md_path_str):
                 logging.info(f"Skipping: {image_path} (Already exists at {md_path_str})")
-                return
+                metrics.status = "skipped"
+                return True, None
             else:
                 logging.info(f"Reprocessing: {image_path}")
 
+        # 新規ファイルの場合は、同じ書類を処理済みでないか確認する
+        if not entry:
+            with metrics.stage("dedupe"):
+                fingerprint = self.compute_fingerprint(image_path)
+                duplicate = self.link_duplicate(img_key, image_path, fingerprint)
+            if duplicate:
+                metrics.status = "duplicate"
+                return True, fingerprint
+        return False, fingerprint
+
+    def _read_image(self, image_path):
+        """送信する画像を読み込む（common.image_payload が有効なら縮小・再エンコードする）"""
+        if self.shaper is not None:
+            return self.shaper.shape_file(image_path)
+        return ImagePayload.from_file(image_path)
+
+    def _build_prompt(self, batch_count=None):
+        """要約用のプロンプト。batch_count を渡すと、複数の画像をまとめて要約するプロンプトにする"""
+        if not batch_count:
+            return self.build_prompt()
+        return self.build_prompt(
+            f"\n\n### 複数の書類の同時処理\n"
+            f"{batch_count}枚の画像（画像 1〜画像 {batch_count}）を送信します。それぞれ別の書類です。\n"
+            f"画像ごとに上記の指示に従ったJSONオブジェクトを作成し、画像の順番どおりに並べた"
+            f"要素数{batch_count}のJSON配列として出力してください。\n"
+        )
+
+    def _process_single(self, image_path, relative_dir, image, img_key, fingerprint, metrics):
+        """読み込み済みの画像1枚を要約して書き出す"""
         logging.info(f"Processing Image: {image_path}")
-        
+
         try:
-            base_prompt = self.config.get('summarizer', {}).get('ai_analysis', {}).get('prompt')
-            classifier_info = ""
-            if 'classification_rules' in self.config.get('summarizer', {}).get('ai_analysis', {}):
-                rules = self.config['summarizer']['ai_analysis']['classification_rules']
-                rules_text = "\n".join([f"- {r['name']}: {r.get('description', '')}" for r in rules])
-                classifier_info = (
-                    f"\n\n### 分類ルールと判定基準\n"
-                    f"以下のカテゴリ名から、書類の内容に最も合致するものを1つだけ選択してください。\n"
-                    f"選択肢:\n{rules_text}\n"
-                )
+            ai_response = self.get_ai_summary([image], custom_prompt=self._build_prompt(), metrics=metrics)
+
+            with metrics.stage("parse"):
+                ai_data = self._parse_ai_response(ai_response, Path(image_path).stem)
+
+            return self._finish(image_path, relative_dir, image, ai_data, ai_response, img_key, fingerprint, metrics)
+
+        except Exception as e:
+            logging.error(f"Error processing {image_path}: {e}")
+            return False
 
-            modified_prompt = f"{classifier_info}\n\n{base_prompt}"
-            ai_response = self.get_ai_summary([Path(image_path)], custom_prompt=modified_prompt)
-            
-            ai_data = self._parse_ai_response(ai_response, Path(image_path).stem)
+    def _finish(self, image_path, relative_dir, image, ai_data, ai_response, img_key, fingerprint, metrics):
+        """要約結果からMarkdownを生成し、履歴の記録と画像のコピーを行う"""
+        # 単一パス取り込み: 読み込んだ画像をそのまま使って全文OCRも行う
+        fulltext = None
+        if self.fulltext_ocr is not None:
+            logging.info(f"Running full-text OCR for {image_path}")
+            with PageSource(image_path, metrics=metrics, shaper=self.shaper) as source:
+                fulltext = self.fulltext_ocr.ocr_document(source, checkpoint_key=img_key, metrics=metrics,
+                                                          rendered={0: image})
 
+        with self._output_lock:
             md_path, copy_path, category = self.get_output_paths(ai_data, image_path, relative_dir)
-            
-            final_file_name = Path(copy_path).name if copy_path else Path(image_path).name
 
-            # 保存
-            self.generate_markdown(md_path, ai_data, ai_response, category, final_file_name)
+        final_file_name = Path(copy_path).name if copy_path else Path(image_path).name
 
-            logging.info(f"Markdown generated: {md_path}")
+        # 保存
+        with metrics.stage("write"):
+            self.generate_markdown(md_path, ai_data, ai_response, category, final_file_name, fulltext)
 
-            final_img_key = str(Path(image_path).resolve()).replace('\\', '/')
-            self.history[final_img_key] = {
-                "md_path": str(Path(md_path).resolve()).replace('\\', '/'),
-                "ocr_completed": False
-            }
-            self.save_history()
+        logging.info(f"Markdown generated: {md_path}")
 
-            if copy_path:
-                import shutil
+        self.history.put(img_key, {
+            "md_path": str(Path(md_path).resolve()).replace('\\', '/'),
+            "ocr_completed": fulltext is not None
+        })
+        if fingerprint is None:
+            with metrics.stage("dedupe"):
+                fingerprint = self.compute_fingerprint(image_path)
+        if fingerprint is not None:
+            self.history.record_fingerprint(img_key, *fingerprint)
+
+        if copy_path:
+            import shutil
+            with metrics.stage("copy"):
                 shutil.copy2(image_path, copy_path)
-                logging.info(f"Image copied to: {copy_path}")
+            logging.info(f"Image copied to: {copy_path}")
 
-        except Exception as e:
-            logging.error(f"Error processing {image_path}: {e}")
+        return True
+
+    def _parse_batch_response(self, ai_response, count):
+        """まとめて要約した応答（JSON配列）を解釈する。要素数が合わない場合などは None を返す"""
+        try:
+            json_match = re.search(r'```json\s*(.*?)\s*```', ai_response, re.DOTALL)
+            if json_match:
+                items = json.loads(json_match.group(1))
+            else:
+                json_str = ai_response.strip()
+                if json_str.startswith("```"):
+                    json_str = re.sub(r'^```[a-z]*\n', '', json_str)
+                    json_str = re.sub(r'\n```$', '', json_str)
+                items = json.loads(json_str)
+        except (TypeError, ValueError):
+            return None
+        if not isinstance(items, list) or len(items) != count or not all(isinstance(item, dict) for item in items):
+            return None
+        return items
 
     def _parse_ai_response(self, ai_response, default_title):
         try:
@@ -1,111 +1,139 @@
 import os
 import logging
-import fitz  # PyMuPDF
 import re
 import json
 from pathlib import Path
+from core.page_source import PageSource
 from .base_processor import BaseProcessor
 
 class PDFProcessor(BaseProcessor):
-    def pdf_to_images(self, pdf_path):
-        """PDFの全ページを一時的にPNG画像に変換する"""
-        images = []
-        try:
-            doc = fitz.open(pdf_path)
-            for i, page in enumerate(doc):
-                pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-                img_path = self.temp_dir / f"{Path(pdf_path).stem}_page_{i}.png"
-                pix.save(str(img_path))
-                images.append(img_path)
-            doc.close()
-        except Exception as e:
-            logging.error(f"Error converting PDF to images: {e}")
-        return images
+    kind = "pdf"
 
-    def process(self, pdf_path, relative_dir=""):
+    def process_file(self, pdf_path, relative_dir, metrics):
         pdf_key = str(Path(pdf_path).resolve()).replace('\\', '/')
         
-        if pdf_key in self.history:
-            entry = self.history[pdf_key]
+        entry = self.history.get(pdf_key)
+        if entry:
             md_path_str = entry["md_path"]
             if not self.should_reprocess(md_path_str):
                 logging.info(f"Skipping: {pdf_path} (Already exists at {md_path_str})")
-                return
+                metrics.status = "skipped"
+                return True
             else:
                 logging.info(f"Reprocessing: {pdf_path}")
 
+        # 新規ファイルの場合は、同じ書類を処理済みでないか確認する
+        fingerprint = None
+        if not entry:
+            with metrics.stage("dedupe"):
+                fingerprint = self.compute_fingerprint(pdf_path)
+                duplicate = self.link_duplicate(pdf_key, pdf_path, fingerprint)
+            if duplicate:
+                metrics.status = "duplicate"
+                return True
+
         logging.info(f"Processing PDF: {pdf_path}")
         
-        image_paths = []
+        source = None
         try:
-            image_paths = self.pdf_to_images(pdf_path)
-            if not image_paths:
-                logging.error("No images generated from PDF.")
-                return
+            try:
+                source = PageSource(pdf_path, self.temp_dir,
+                                    keep_files=self.config['common'].get('keep_temp_files', False),
+                                    metrics=metrics, shaper=self.shaper, pool=self.render_pool)
+            except Exception as e:
+                logging.error(f"Error opening PDF: {e}")
+                return False
+
+            total_pages = source.page_count
+            if total_pages == 0:
+                logging.error("No pages found in PDF.")
+                return False
 
-            total_pages = len(image_paths)
             max_pages = self.config.get('summarizer', {}).get('ai_analysis', {}).get('max_pages_to_ai', 5)
             
-            ai_image_paths = image_paths
+            page_indices, blank_pages = self._select_pages(source, max_pages)
             sampling_info = ""
             
-            if total_pages > max_pages:
-                first_part = image_paths[:max_pages - 1]
-                last_page = [image_paths[-1]]
-                ai_image_paths = first_part + last_page
-                sampled_indices = [i + 1 for i in range(max_pages - 1)] + [total_pages]
-                sampling_info = f"\n\n(注意: この書類は全{total_pages}ページありますが、現在はコンテキスト節約のため、{', '.join(map(str, sampled_indices))}ページ目のみを抜粋して送信しています。)"
-                logging.info(f"Sampling applied: sending {len(ai_image_paths)}/{total_pages} pages.")
-
-            base_prompt = self.config.get('summarizer', {}).get('ai_analysis', {}).get('prompt')
-            classifier_info = ""
-            if 'classification_rules' in self.config.get('summarizer', {}).get('ai_analysis', {}):
-                rules = self.config['summarizer']['ai_analysis']['classification_rules']
-                rules_text = "\n".join([f"- {r['name']}: {r.get('description', '')}" for r in rules])
-                classifier_info = (
-                    f"\n\n### 分類ルールと判定基準\n"
-                    f"以下のカテゴリ名から、書類の内容に最も合致するものを1つだけ選択してください。\n"
-                    f"選択肢:\n{rules_text}\n"
-                )
-
-            modified_prompt = f"{sampling_info}{classifier_info}\n\n{base_prompt}"
-            ai_response = self.get_ai_summary(ai_image_paths, custom_prompt=modified_prompt)
+            if len(page_indices) < total_pages:
+                sampled_indices = [i + 1 for i in page_indices]
+                blank_info = f"（白紙の{len(blank_pages)}ページは除外）" if blank_pages else ""
+                sampling_info = f"\n\n(注意: この書類は全{total_pages}ページありますが、現在はコンテキスト節約のため、{', '.join(map(str, sampled_indices))}ページ目のみを抜粋して送信しています{blank_info}。)"
+                logging.info(f"Sampling applied: sending {len(page_indices)}/{total_pages} pages "
+                             f"({len(blank_pages)} blank).")
+
+            # AIに送信するページのみをメモリ上で画像化する
+            lookahead = self.config['common'].get('render_lookahead', 2)
+            ai_images = [payload for _, payload in source.iter_pages(page_indices, lookahead)]
+
+            # 書類ごとの注記はプロンプトの固定部分の後ろに付ける（プロンプトキャッシュを効かせるため）
+            modified_prompt = self.build_prompt(sampling_info)
+            ai_response = self.get_ai_summary(ai_images, custom_prompt=modified_prompt, metrics=metrics)
             
             # AI応答のパース
-            ai_data = self._parse_ai_response(ai_response, Path(pdf_path).stem)
+            with metrics.stage("parse"):
+                ai_data = self._parse_ai_response(ai_response, Path(pdf_path).stem)
+
+            # 単一パス取り込み: 要約用に画像化したページを再利用して全文OCRも行う
+            fulltext = None
+            if self.fulltext_ocr is not None:
+                logging.info(f"Running full-text OCR for {pdf_path}")
+                fulltext = self.fulltext_ocr.ocr_document(source, checkpoint_key=pdf_key, metrics=metrics,
+                                                          rendered=dict(zip(page_indices, ai_images)))
+
+            # 出力先決定（並行処理時のファイル名衝突を防ぐためロック内で行う。割り当てたパスは予約済みになる）
+            with self._output_lock:
+                md_path, copy_path, category = self.get_output_paths(ai_data, pdf_path, relative_dir)
 
-            # 出力先決定
-            md_path, copy_path, category = self.get_output_paths(ai_data, pdf_path, relative_dir)
-            
             # 最終的なファイル名の取得（リンク用）
             final_file_name = Path(copy_path).name if copy_path else Path(pdf_path).name
 
             # Markdown生成
-            self.generate_markdown(md_path, ai_data, ai_response, category, final_file_name)
+            with metrics.stage("write"):
+                self.generate_markdown(md_path, ai_data, ai_response, category, final_file_name, fulltext)
 
             logging.info(f"Markdown generated: {md_path}")
 
             # 履歴更新
             final_pdf_key = str(Path(pdf_path).resolve()).replace('\\', '/')
-            self.history[final_pdf_key] = {
+            self.history.put(final_pdf_key, {
                 "md_path": str(Path(md_path).resolve()).replace('\\', '/'),
-                "ocr_completed": False
-            }
-            self.save_history()
+                "ocr_completed": fulltext is not None
+            })
+            if fingerprint is None:
+                with metrics.stage("dedupe"):
+                    fingerprint = self.compute_fingerprint(pdf_path)
+            if fingerprint is not None:
+                self.history.record_fingerprint(final_pdf_key, *fingerprint)
 
             # PDFコピー
             if copy_path:
                 import shutil
-                shutil.copy2(pdf_path, copy_path)
+                with metrics.stage("copy"):
+                    shutil.copy2(pdf_path, copy_path)
                 logging.info(f"PDF copied to: {copy_path}")
 
+            return True
+
         except Exception as e:
             logging.error(f"Error processing {pdf_path}: {e}")
+            return False
         finally:
-            if not self.config['common'].get('keep_temp_files', False):
-                for img_path in image_paths:
-                    if img_path.exists():
-                        img_path.unlink()
+            if source is not None:
+                source.close()
+
+    def _select_pages(self, source, max_pages):
+        """AIに送るページ番号（0始まり）と、白紙と判定したページ番号を返す
+
+        common.page_analysis が無効な場合は、先頭 max_pages - 1 ページと最後のページを送る。
+        """
+        total_pages = source.page_count
+        if self.page_analyzer is None:
+            if total_pages <= max_pages:
+                return list(range(total_pages)), []
+            return list(range(max_pages - 1)) + [total_pages - 1], []
+        profiles = list(source.profiles(self.page_analyzer).values())
+        blank_pages = [p.index for p in profiles if p.blank]
+        return self.page_analyzer.select_pages(profiles, max_pages), blank_pages
 
     def _parse_ai_response(self, ai_response, default_title):
         try:
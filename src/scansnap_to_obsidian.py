@@ -1,9 +1,18 @@
 import os
 import json
 import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
 from processors.pdf_processor import PDFProcessor
 from processors.image_processor import ImageProcessor
+from core.llm_cache import log_llm_cache_stats
+from core.llm_router import log_llm_router_stats
+from core.metrics import write_metrics_snapshot
+from core.render_pool import shutdown_render_pool
+from core.scan_index import open_scan_index
+from core.watcher import create_watcher, WriteSettler
 
 # ロギング設定
 logging.basicConfig(level=logging.INFO,
@@ -11,6 +20,11 @@ logging.basicConfig(level=logging.INFO,
                     datefmt='%Y-%m-%d %H:%M:%S')
 
 def main():
+    parser = argparse.ArgumentParser(description="ScanSnap書類をAIで要約し、Obsidianへ取り込む")
+    parser.add_argument("--watch", action="store_true",
+                        help="既存ファイルの処理後も常駐し、入力ディレクトリに追加されたファイルを随時処理する")
+    args = parser.parse_args()
+
     script_dir = Path(__file__).parent
     config_path = script_dir.parent / 'config' / 'config.json'
     if not config_path.exists():
@@ -55,7 +69,15 @@ def main():
 
     # 重複排除（同じディレクトリを二度処理しないよう）
     seen_dirs = set()
-    
+
+    # 差分走査: 前回から増えた・変わったファイルだけを対象にする（強制再処理時は全件走査）
+    control = sum_config.get('control', {})
+    scan_index = None
+    if control.get('incremental_scan') and not control.get('force_reprocess'):
+        scan_index = open_scan_index(config)
+
+    # 処理対象のディレクトリごとにプロセッサを用意する
+    active_targets = []
     for target in processing_targets:
         input_base_dir = target["input_dir"]
         if not input_base_dir or not os.path.exists(input_base_dir):
@@ -66,8 +88,6 @@ def main():
             continue
         seen_dirs.add(target_key)
 
-        logging.info(f"Scanning directory for {target['type']}: {input_base_dir}")
-        
         if target["type"] == "pdf":
             processor = PDFProcessor(config, target["format_config"])
             extensions = ('.pdf',)
@@ -76,8 +96,37 @@ def main():
             extensions = ('.jpg', '.jpeg')
         else:
             continue
+        active_targets.append({
+            "type": target["type"],
+            "input_dir": os.path.normpath(input_base_dir),
+            "processor": processor,
+            "extensions": extensions,
+            "scope": f"{target['type']}:{target_key[1]}",
+        })
+
+    # 常駐する場合は、既存ファイルの走査より前に監視を始める
+    # （既存ファイルの処理中に追加されたファイルも、処理後に拾えるようにするため）
+    watcher = None
+    if args.watch and active_targets:
+        watcher = create_watcher([t["input_dir"] for t in active_targets],
+                                 tuple({ext for t in active_targets for ext in t["extensions"]}),
+                                 poll_interval=sum_config.get('watch', {}).get('poll_interval', 5))
+
+    # 処理対象ファイルを (プロセッサ, パス, 相対ディレクトリ, 種別, 成功時の処理) のリストとして収集
+    tasks = []
+    for target in active_targets:
+        input_base_dir = target["input_dir"]
+        processor = target["processor"]
+        extensions = target["extensions"]
+        logging.info(f"Scanning directory for {target['type']}: {input_base_dir}")
+
+        if scan_index is not None:
+            scope = target["scope"]
+            for full_path, relative_dir, signature in scan_index.scan(scope, input_base_dir, extensions):
+                on_success = partial(scan_index.mark_done, scope, full_path, signature)
+                tasks.append((processor, full_path, relative_dir, target["type"], on_success))
+            continue
 
-        processed_count = 0
         for root, dirs, files in os.walk(input_base_dir):
             relative_dir = os.path.relpath(root, input_base_dir)
             if relative_dir == ".":
@@ -87,10 +136,149 @@ def main():
             
             for file_name in target_files:
                 full_path = os.path.join(root, file_name)
-                processor.process(full_path, relative_dir)
-                processed_count += 1
+                tasks.append((processor, full_path, relative_dir, target["type"], None))
+
+    if scan_index is not None and not tasks:
+        logging.info("No new or changed files.")
+    else:
+        run_tasks(tasks, control.get('max_workers', 1))
+        log_llm_cache_stats()
+        log_llm_router_stats()
+    # 処理がなかった場合も、前回の集計が残らないよう書き出す
+    write_metrics_snapshot("scansnap_to_obsidian")
+
+    if args.watch:
+        watch_targets(active_targets, sum_config, watcher, scan_index)
+    shutdown_render_pool()
+
+
+def watch_targets(targets, sum_config, watcher, scan_index=None):
+    """入力ディレクトリを監視し、書き込みが完了したファイルを順次処理する（Ctrl+C で終了）
 
-        logging.info(f"Finished processing {target['type']}: {processed_count} files found.")
+    プロセッサ（LLMへの接続・設定）は起動時のものを使い回す。watcher は既存ファイルの
+    処理前に作成したもので、その間に追加されたファイルもここで処理される。
+    scan_index（差分走査）を渡すと、処理に成功したファイルを走査済みとして記録する。
+    """
+    if not targets:
+        logging.error("No input directories to watch.")
+        return
+
+    watch_cfg = sum_config.get('watch', {})
+    settler = WriteSettler(watch_cfg.get('settle_seconds', 5))
+    max_workers = max(1, int(sum_config.get('control', {}).get('max_workers', 1) or 1))
+    in_flight = set()
+
+    def find_target(path):
+        for target in targets:
+            if path.lower().endswith(target["extensions"]) and \
+                    os.path.commonpath([target["input_dir"], path]) == target["input_dir"]:
+                return target
+        return None
+
+    def run(target, path):
+        try:
+            relative_dir = os.path.relpath(os.path.dirname(path), target["input_dir"])
+            if target["processor"].process(path, "" if relative_dir == "." else relative_dir) and \
+                    scan_index is not None:
+                scan_index.mark_done(target["scope"], path)
+        except Exception as e:
+            logging.error(f"Unexpected error processing {path}: {e}")
+        finally:
+            in_flight.discard(path)
+            # 常駐中も textfile collector が最新の集計を読めるよう、1件ごとに書き出す
+            write_metrics_snapshot("scansnap_to_obsidian")
+
+    logging.info(f"Watching {len(targets)} directories for new files ({type(watcher).__name__}). Press Ctrl+C to stop.")
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                for path in watcher.poll(timeout=1.0):
+                    if find_target(path) is not None:
+                        settler.touch(path)
+                for path in settler.ready():
+                    target = find_target(path)
+                    if target is None or path in in_flight:
+                        continue
+                    in_flight.add(path)
+                    logging.info(f"New file detected: {path}")
+                    executor.submit(run, target, path)
+    except KeyboardInterrupt:
+        logging.info("Stopping watch mode.")
+    finally:
+        watcher.close()
+        log_llm_cache_stats()
+        log_llm_router_stats()
+        write_metrics_snapshot("scansnap_to_obsidian")
+
+
+def run_tasks(tasks, max_workers=1):
+    """収集したファイルを処理する。max_workers > 1 の場合は書類単位で並行処理する
+
+    ラスタライズ、AI通信、ファイル書き込みが書類をまたいで重なり合うため、
+    LLMサーバーの待ち時間を減らせる。LLMへの同時リクエスト数は
+    サーバーごとに別途制限される（core.llm_router）。
+    JPEGのバッチ処理が有効な場合、小さな画像はまとめて1つの作業単位として処理する。
+    """
+    processed_counts = {}
+    max_workers = max(1, int(max_workers or 1))
+    units = group_batches(tasks)
+
+    def run(processor, items):
+        if len(items) == 1:
+            full_path, relative_dir, _ = items[0]
+            results = [processor.process(full_path, relative_dir)]
+        else:
+            results = processor.process_batch([(full_path, relative_dir) for full_path, relative_dir, _ in items])
+        for (_, _, on_success), result in zip(items, results):
+            if result and on_success is not None:
+                on_success()
+
+    if max_workers == 1:
+        for processor, items, file_type in units:
+            run(processor, items)
+            processed_counts[file_type] = processed_counts.get(file_type, 0) + len(items)
+    else:
+        logging.info(f"Processing {len(tasks)} files with {max_workers} workers.")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(run, processor, items): (items, file_type)
+                for processor, items, file_type in units
+            }
+            for future in as_completed(futures):
+                items, file_type = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error(f"Unexpected error processing {', '.join(item[0] for item in items)}: {e}")
+                processed_counts[file_type] = processed_counts.get(file_type, 0) + len(items)
+
+    for file_type, count in processed_counts.items():
+        logging.info(f"Finished processing {file_type}: {count} files found.")
+
+
+def group_batches(tasks):
+    """処理対象を作業単位 (プロセッサ, [(パス, 相対ディレクトリ, 成功時の処理), ...], 種別) にまとめる
+
+    バッチ処理に対応したプロセッサ（ImageProcessor）が対象にできるファイルは
+    batch_size 件ずつまとめ、それ以外は1件ずつの作業単位にする。
+    """
+    units = []
+    open_batches = {}
+    for processor, full_path, relative_dir, file_type, on_success in tasks:
+        item = (full_path, relative_dir, on_success)
+        can_batch = getattr(processor, "can_batch", None)
+        if can_batch is None or not can_batch(full_path):
+            units.append((processor, [item], file_type))
+            continue
+        batch = open_batches.get(id(processor))
+        if batch is None:
+            batch = (processor, [], file_type)
+            open_batches[id(processor)] = batch
+            units.append(batch)
+        batch[1].append(item)
+        if len(batch[1]) >= processor.batch_size:
+            del open_batches[id(processor)]
+    return units
 
 if __name__ == "__main__":
     main()